@@ -0,0 +1,180 @@
+"""Offline benchmark of the context pipeline against the mock OpenRouter server.
+
+For each session size a synthetic story is stored in a throwaway database,
+then a number of turns are run and timed. Reported per size:
+
+  p50 / p99     turn latency in milliseconds
+  llm/turn      LLM calls per turn (chat, summary, compress)
+  db/turn       SQL statements per turn (transaction control excluded)
+  tokens/turn   prompt tokens sent to the LLM per turn, all calls
+
+Usage:
+  python -m benchmarks.bench --sizes 10,100,1000,10000 --turns 20
+  python -m benchmarks.bench --mode stream --latency 0.2 --json results.json
+
+Modes: "context" times build_context and store_turn without an LLM call,
+"chat" and "stream" drive the /api/chat and /api/chat/stream endpoints end
+to end.
+"""
+import argparse
+import contextlib
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+# Point the app at a throwaway database, and quiet its logs, before any repo module reads config
+os.environ.setdefault("DB_NAME", os.path.join(tempfile.mkdtemp(prefix="story-bench-"), "bench.db"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from benchmarks.mock_openrouter import FILLER, MockOpenRouter
+from benchmarks.sessions import create_session, synthetic_prompt
+
+
+TRANSACTION_CONTROL = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE")
+
+
+class QueryCounter:
+    """Counts SQL statements across all threads (see database.set_query_tracer)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def __call__(self, sql: str):
+        if sql.lstrip().upper().startswith(TRANSACTION_CONTROL):
+            return
+        with self._lock:
+            self.count += 1
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def run_turn(mode: str, client, session_id: str, prompt: str):
+    """One user turn through the chosen entry point"""
+    if mode == "context":
+        from context import build_context_with_report
+        from database import store_turn
+        build_context_with_report(session_id, prompt)
+        store_turn(session_id, prompt, FILLER)
+        return
+
+    body = {"prompt": prompt, "session_id": session_id}
+    if mode == "chat":
+        response = client.post("/api/chat", json=body)
+    else:
+        response = client.post("/api/chat/stream", json=body)
+    response.raise_for_status()
+    response.read()
+
+
+def bench_size(mode: str, client, mock: MockOpenRouter, queries: QueryCounter,
+               size: int, turns: int, seed: int) -> Dict:
+    session_id = f"bench-{size}-{seed}"
+    create_session(session_id, size, seed)
+
+    rng = random.Random(seed)
+    latencies = []
+    before = mock.stats.snapshot()
+    queries_before = queries.count
+
+    for _ in range(turns):
+        start = time.perf_counter()
+        run_turn(mode, client, session_id, synthetic_prompt(rng))
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    after = mock.stats.snapshot()
+    calls = after["calls"] - before["calls"]
+    tokens = after["prompt_tokens"] - before["prompt_tokens"]
+
+    return {
+        "size": size,
+        "turns": turns,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "llm_calls_per_turn": round(sum(calls.values()) / turns, 2),
+        "llm_calls": dict(calls),
+        "db_queries_per_turn": round((queries.count - queries_before) / turns, 1),
+        "tokens_sent_per_turn": round(sum(tokens.values()) / turns),
+    }
+
+
+def print_table(mode: str, results: List[Dict]):
+    print(f"\nmode={mode}")
+    print(f"{'size':>7} {'p50 ms':>9} {'p99 ms':>9} {'llm/turn':>9} {'db/turn':>8} {'tokens/turn':>12}  calls")
+    for r in results:
+        calls = ", ".join(f"{kind}={count}" for kind, count in sorted(r['llm_calls'].items()))
+        print(f"{r['size']:>7} {r['p50_ms']:>9} {r['p99_ms']:>9} {r['llm_calls_per_turn']:>9} "
+              f"{r['db_queries_per_turn']:>8} {r['tokens_sent_per_turn']:>12}  {calls}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the context pipeline offline")
+    parser.add_argument("--mode", choices=["context", "chat", "stream"], default="chat")
+    parser.add_argument("--sizes", default="10,100,1000", help="comma-separated session sizes (messages)")
+    parser.add_argument("--turns", type=int, default=20, help="timed turns per session size")
+    parser.add_argument("--latency", type=float, default=0.05, help="mock LLM latency in seconds")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument("--cached-ratio", type=float, default=0.0, help="share of prompt tokens reported cached")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the app's own logs")
+    args = parser.parse_args()
+
+    mock = MockOpenRouter(latency=args.latency, chunk_delay=args.chunk_delay, cached_ratio=args.cached_ratio)
+    mock.start()
+
+    # Imported here so the DB_NAME override above is already in place
+    from database import init_database, set_query_tracer
+    from llm_utils import llm_client
+    from rate_limiter import rate_limiter
+
+    llm_client.url = mock.url
+    llm_client.api_key = llm_client.api_key or "benchmark"
+
+    # Benchmarks measure the pipeline, not the request limits
+    rate_limiter.session_rate = rate_limiter.global_rate = 1e9
+    rate_limiter.session_burst = rate_limiter.global_burst = 1e9
+
+    queries = QueryCounter()
+    results = []
+
+    init_database()
+    if args.mode == "context":
+        client = contextlib.nullcontext()
+    else:
+        from fastapi.testclient import TestClient
+        from main import app
+        client = TestClient(app)
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+
+    with client as active_client:
+        set_query_tracer(queries)
+        for size in (int(s) for s in args.sizes.split(",") if s.strip()):
+            results.append(bench_size(args.mode, active_client, mock, queries, size, args.turns, args.seed))
+        set_query_tracer(None)
+
+    mock.stop()
+    print_table(args.mode, results)
+    print(f"database: {os.environ['DB_NAME']}", file=sys.stderr)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"mode": args.mode, "latency": args.latency, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
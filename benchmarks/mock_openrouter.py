@@ -0,0 +1,193 @@
+"""Local stand-in for the OpenRouter chat completions endpoint.
+
+Answers the same request format as OpenRouter, with configurable latency,
+streaming and usage payloads, and counts what it was sent so benchmarks
+can report LLM calls and tokens per turn without a real API key.
+
+Run standalone:  python -m benchmarks.mock_openrouter --port 8400 --latency 0.2
+then point the app at it with OPENROUTER_URL=http://127.0.0.1:8400/api/v1/chat/completions
+"""
+import argparse
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+from config import SUMMARY_PROMPT, COMPRESS_PROMPT
+from tokenizer import count_context_tokens
+
+
+FILLER = ("The lantern light flickered across the old stone walls as the travellers "
+          "weighed what the stranger had told them about the road ahead. ")
+
+
+def classify(messages: List[Dict]) -> str:
+    """Which pipeline stage sent a request: summary, compress or chat"""
+    first = messages[0]['content'] if messages else ""
+    if first == SUMMARY_PROMPT:
+        return "summary"
+    if first == COMPRESS_PROMPT:
+        return "compress"
+    return "chat"
+
+
+class MockStats:
+    """Thread-safe tallies of the requests the mock server has answered"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = Counter()
+        self.prompt_tokens = Counter()
+
+    def record(self, kind: str, prompt_tokens: int):
+        with self._lock:
+            self.calls[kind] += 1
+            self.prompt_tokens[kind] += prompt_tokens
+
+    def snapshot(self) -> Dict[str, Counter]:
+        with self._lock:
+            return {"calls": Counter(self.calls), "prompt_tokens": Counter(self.prompt_tokens)}
+
+
+class MockOpenRouter:
+    """Chat completions server on 127.0.0.1, run in a background thread.
+
+    latency:           seconds before the first byte of every response
+    completion_tokens: approximate size of each reply (capped by max_tokens)
+    chunks:            number of SSE chunks a streamed reply is split into
+    chunk_delay:       seconds between streamed chunks
+    cached_ratio:      share of prompt tokens reported as prompt-cache hits
+    stream_usage:      send a final usage chunk on streams, as OpenRouter does
+                       when asked with stream_options.include_usage
+    """
+
+    def __init__(self, latency: float = 0.05, completion_tokens: int = 300, chunks: int = 20,
+                 chunk_delay: float = 0.0, cached_ratio: float = 0.0, stream_usage: bool = True,
+                 port: int = 0):
+        self.latency = latency
+        self.completion_tokens = completion_tokens
+        self.chunks = max(1, chunks)
+        self.chunk_delay = chunk_delay
+        self.cached_ratio = cached_ratio
+        self.stream_usage = stream_usage
+        self.stats = MockStats()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api/v1/chat/completions"
+
+    def start(self) -> str:
+        """Start serving; returns the chat completions URL"""
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-openrouter", daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reply_text(self, kind: str, max_tokens: int) -> str:
+        tokens = min(self.completion_tokens, max_tokens or self.completion_tokens)
+        if kind == "compress":
+            tokens = min(tokens, 150)
+        repeats = max(1, tokens * 4 // len(FILLER))
+        return (FILLER * repeats).strip()
+
+    def usage(self, prompt_tokens: int, completion_tokens: int) -> Dict:
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": int(prompt_tokens * self.cached_ratio)},
+            "completion_tokens_details": {"reasoning_tokens": 0},
+        }
+
+    def _handler_class(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                messages = payload.get("messages", [])
+                kind = classify(messages)
+                prompt_tokens = count_context_tokens([{"content": msg.get("content", "")} for msg in messages])
+                mock.stats.record(kind, prompt_tokens)
+
+                time.sleep(mock.latency)
+                text = mock.reply_text(kind, payload.get("max_tokens"))
+                usage = mock.usage(prompt_tokens, len(text) // 4)
+
+                if payload.get("stream"):
+                    self._stream(text, usage)
+                else:
+                    self._respond(text, usage, payload.get("model"))
+
+            def _respond(self, text: str, usage: Dict, model: str):
+                body = json.dumps({
+                    "id": "mock",
+                    "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                                 "finish_reason": "stop"}],
+                    "usage": usage,
+                }).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _stream(self, text: str, usage: Dict):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+
+                size = max(1, len(text) // mock.chunks + 1)
+                for start in range(0, len(text), size):
+                    chunk = {"choices": [{"index": 0, "delta": {"content": text[start:start + size]}}]}
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                    if mock.chunk_delay:
+                        time.sleep(mock.chunk_delay)
+
+                if mock.stream_usage:
+                    self.wfile.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode("utf-8"))
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local mock of the OpenRouter chat completions API")
+    parser.add_argument("--port", type=int, default=8400)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before each response")
+    parser.add_argument("--completion-tokens", type=int, default=300)
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument("--cached-ratio", type=float, default=0.0, help="share of prompt tokens reported as cached")
+    args = parser.parse_args()
+
+    mock = MockOpenRouter(latency=args.latency, completion_tokens=args.completion_tokens,
+                          chunk_delay=args.chunk_delay, cached_ratio=args.cached_ratio, port=args.port)
+    print(f"🧪 Mock OpenRouter listening on {mock.url}")
+    try:
+        mock._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
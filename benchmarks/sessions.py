@@ -0,0 +1,54 @@
+"""Synthetic story sessions for benchmarks"""
+import random
+from typing import Iterator, Tuple
+
+from database import store_message_with_usage, transaction
+
+
+CHARACTERS = ["Mara", "Tobin", "Elspeth", "Corvin", "Ysolde", "Bram", "Ilya", "Nessa"]
+PLACES = ["the drowned abbey", "Greyhollow", "the salt market", "the northern pass",
+          "the lighthouse", "Vell's tavern", "the archive vaults", "the ash fields"]
+OBJECTS = ["a cracked compass", "the silver key", "a sealed letter", "the ember lantern",
+           "a map of the tunnels", "the broken crown", "a vial of black ink"]
+ACTIONS = ["searches", "argues about", "hides", "follows the trail to", "bargains over",
+           "remembers", "discovers", "loses"]
+
+PROMPTS = [
+    "Continue the story. {who} returns to {where}.",
+    "What happens when {who} finds {what}?",
+    "Write the next scene: {who} confronts an old friend at {where}.",
+    "Bring back {what} from earlier and show why it matters.",
+]
+
+# Every LONG_EVERY-th message is long enough to be compressed
+LONG_EVERY = 37
+
+
+def _sentence(rng: random.Random) -> str:
+    return (f"{rng.choice(CHARACTERS)} {rng.choice(ACTIONS)} {rng.choice(OBJECTS)} "
+            f"near {rng.choice(PLACES)}, while {rng.choice(CHARACTERS)} watches in silence.")
+
+
+def synthetic_messages(count: int, seed: int = 0) -> Iterator[Tuple[str, str]]:
+    """Yield (role, content) pairs for an alternating user/assistant story"""
+    rng = random.Random(seed)
+
+    for i in range(count):
+        if i % 2 == 0:
+            yield "user", synthetic_prompt(rng)
+        else:
+            sentences = 400 if i % LONG_EVERY == 0 else rng.randint(8, 40)
+            yield "assistant", " ".join(_sentence(rng) for _ in range(sentences))
+
+
+def synthetic_prompt(rng: random.Random) -> str:
+    return rng.choice(PROMPTS).format(
+        who=rng.choice(CHARACTERS), where=rng.choice(PLACES), what=rng.choice(OBJECTS)
+    )
+
+
+def create_session(session_id: str, count: int, seed: int = 0):
+    """Store a synthetic session of count messages"""
+    with transaction(immediate=True):
+        for role, content in synthetic_messages(count, seed):
+            store_message_with_usage(session_id, role, content)
@@ -4,34 +4,120 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # API Configuration
+# Checked when the first LLM request is made, so offline tools can import config
 OPENROUTER_KEY = os.getenv("OPENROUTER_API_KEY")
-if not OPENROUTER_KEY:
-    raise RuntimeError("Set OPENROUTER_API_KEY env var")
 
-OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+
+# HTTP client (shared keep-alive pool for all LLM calls)
+LLM_CONNECT_TIMEOUT = 10.0          # Seconds to establish a connection
+LLM_READ_TIMEOUT = 120.0            # Seconds to wait for response data
+LLM_POOL_SIZE = 20                  # Max pooled connections to the provider
+LLM_HTTP2 = True                    # Use HTTP/2 when the h2 package is installed
+LLM_MAX_RETRIES = 3                 # Retries for 408/429/5xx and connection errors
+LLM_BACKOFF_BASE = 0.5              # Seconds, doubled per retry (with full jitter)
+LLM_BACKOFF_MAX = 30.0              # Cap on a single retry delay (incl. Retry-After)
+LLM_CIRCUIT_FAILURES = 5            # Consecutive failures before failing fast
+LLM_CIRCUIT_COOLDOWN = 30.0         # Seconds before a trial call is let through
 
 # Model Configuration
-MODEL_CONFIG = {
-    "name": "x-ai/grok-4-fast",
-    "max_output": 4000,
-    "input_cost_per_1m": 0.20,
-    "output_cost_per_1m": 0.50
+# Every model the app may call, with its pricing (USD per 1M tokens)
+MODELS = {
+    "x-ai/grok-4-fast": {
+        "max_output": 4000,
+        "input_cost_per_1m": 0.20,
+        "output_cost_per_1m": 0.50,
+        "cached_input_cost_per_1m": 0.05,   # Prompt tokens served from the provider's prefix cache
+        "tokenizer": "o200k_base"       # Local BPE encoding used for token counts
+    },
+    "openai/gpt-4o-mini": {
+        "max_output": 4000,
+        "input_cost_per_1m": 0.15,
+        "output_cost_per_1m": 0.60,
+        "cached_input_cost_per_1m": 0.075,
+        "tokenizer": "o200k_base"
+    },
+}
+# Models per task, tried in order: the first, then the next whenever one errors.
+# Point "summary" and "compress" at a cheaper, faster model to cut background spend
+MODEL_ROUTES = {
+    "chat": ["x-ai/grok-4-fast", "openai/gpt-4o-mini"],
+    "summary": ["x-ai/grok-4-fast", "openai/gpt-4o-mini"],
+    "compress": ["x-ai/grok-4-fast", "openai/gpt-4o-mini"],
 }
+# The default chat model (used for token counting and request defaults)
+MODEL_CONFIG = {"name": MODEL_ROUTES["chat"][0], **MODELS[MODEL_ROUTES["chat"][0]]}
+MESSAGE_TOKEN_OVERHEAD = 4          # Chat-format tokens added per message
 
 # Strategy Settings
 RECENT_MESSAGE_COUNT = 15           # Keep last 10 messages in full
 SUMMARIZE_THRESHOLD = 15            # Start summarizing after 10 messages
 SUMMARY_MAX_TOKENS = 2500           # Max tokens for summary
-MESSAGE_COMPRESS_THRESHOLD = 2500   # Compress messages longer than this
+SUMMARY_REFRESH_INTERVAL = 10       # Summarize old messages in chunks of this many
+SUMMARY_TREE_FANOUT = 4             # Merge this many same-level summary nodes into one
+SUMMARY_NODE_MAX_TOKENS = 1000      # Max tokens for a single summary tree node
+SUMMARY_BACKGROUND = True           # Precompute summaries in background workers
+SUMMARY_WORKERS = 2                 # Background summarization threads
+SUMMARY_MAX_LAG = 20                # Max messages a stale summary may lag behind
+MESSAGE_COMPRESS_THRESHOLD = 2500   # Messages longer than this may be compressed to fit the budget
 MESSAGE_COMPRESSED_SIZE = 2500       # Compress to this size
-TARGET_INPUT_TOKENS = 20000         # Target input size
-MAX_INPUT_TOKENS = 50000            # Safety limit
+COMPRESSION_WORKERS = 4             # Messages compressed in parallel per request
+COMPRESSION_DEADLINE = 30.0         # Seconds to wait for compressions before truncating instead
+TARGET_INPUT_TOKENS = 20000         # Target input size the context packer fills up to
+MAX_INPUT_TOKENS = 50000            # Hard limit, never exceeded
+SINGLE_FLIGHT_LEASE_TTL = 180.0     # Seconds a worker may hold a summary/compression lease
+SINGLE_FLIGHT_POLL_INTERVAL = 0.5   # Seconds between checks while another worker holds it
+CONTEXT_LAYOUT = "cache_friendly"   # "cache_friendly" keeps a stable prefix for prompt caching, "classic" is the old order
+
+# Retrieval of archived messages relevant to the current prompt (SQLite FTS5)
+RETRIEVAL_ENABLED = True
+RETRIEVAL_TOP_K = 4                 # Max passages injected per request
+RETRIEVAL_TOKEN_BUDGET = 2000       # Max tokens of injected passages
+RETRIEVAL_MAX_TERMS = 16            # Max search terms taken from the prompt
+
+# Rate Limiting (token buckets, shared by all workers through SQLite)
+MIN_REQUEST_INTERVAL = 2            # Sustained seconds between requests per session
+RATE_LIMIT_SESSION_BURST = 3        # Requests a session may make back-to-back
+RATE_LIMIT_GLOBAL_RATE = 5.0        # Sustained requests per second, all sessions
+RATE_LIMIT_GLOBAL_BURST = 20        # Back-to-back requests, all sessions
+RATE_LIMIT_POLICY = "queue"         # "queue" waits for a token, "reject" returns 429
+RATE_LIMIT_MAX_WAIT = 5.0           # Longest a queued request waits before a 429
+
+# Maintenance: summary retention and space reclamation, run in the background
+SUMMARY_KEEP_CHECKPOINTS = 3        # Older summaries kept per session besides the latest
+SUMMARY_CHECKPOINT_EVERY = 100      # ...chosen among coverages that are multiples of this
+MAINTENANCE_INTERVAL = 600.0        # Seconds between background maintenance runs (0 = off)
+MAINTENANCE_BATCH_SIZE = 500        # Summaries deleted per transaction
+VACUUM_PAGES_PER_RUN = 2000         # Free pages returned to the OS per run
 
-# Rate Limiting
-MIN_REQUEST_INTERVAL = 2  # seconds
+# Logging: DEBUG shows every context-building step, WARNING keeps only problems
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 
 # Database
-DB_NAME = "story_conversations.db"
+DB_NAME = os.getenv("DB_NAME", "story_conversations.db")
+DB_BUSY_TIMEOUT = 30.0              # Seconds to wait on a locked database
+DB_MMAP_SIZE = 256 * 1024 * 1024    # Memory-map up to 256MB of the DB file
+DB_STATEMENT_CACHE_SIZE = 256       # Prepared statements cached per connection
+
+# Group commit: concurrent chat turns are written by one background writer, many per transaction
+TURN_GROUP_COMMIT = False           # Off: each turn commits on its own
+TURN_GROUP_MAX_DELAY = 0.005        # Seconds the writer waits for more turns to join a batch
+TURN_GROUP_MAX_SIZE = 64            # Most turns per transaction
+
+# Bulk import (transfer.py)
+IMPORT_BATCH_SIZE = 5000            # Rows per transaction
+IMPORT_SUMMARY_WORKERS = 4          # Sessions whose summaries are rebuilt at once after an import
+
+# In-process cache of hot session state (recent messages, summaries), written through on every store
+SESSION_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Approximate memory budget; 0 disables the cache
+SESSION_CACHE_VALIDATE = True       # One-row check per turn for writes by other worker processes
+
+# At-rest compression of message and summary text (zlib with a dictionary trained on this deployment)
+STORAGE_COMPRESSION = True          # Encode new rows, and migrate old ones in the background
+STORAGE_COMPRESS_MIN_BYTES = 200    # Shorter texts are stored as plain TEXT
+STORAGE_COMPRESSION_LEVEL = 6       # zlib level, 1 (fast) to 9 (small)
+STORAGE_DICT_SAMPLE_BYTES = 1024 * 1024  # Stored text sampled to train the dictionary
+STORAGE_DICT_MIN_SAMPLE = 256 * 1024     # Text needed before a dictionary is trained
 
 # Prompts
 STORY_SYSTEM_PROMPT = """
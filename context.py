@@ -1,37 +1,537 @@
-from typing import List, Dict
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, List, Dict, Optional
 from database import (
     count_messages,
-    get_all_messages,
-    get_last_n_messages,
+    get_session_state,
     get_messages_range,
     get_cached_summary,
     get_latest_cached_summary,
     cache_summary,
+    get_summary_nodes,
+    store_summary_node,
+    get_compressed_message,
+    find_compressed_content,
+    cache_compressed_message,
+    acquire_lease,
+    release_lease,
+    cache_token_counts,
+    record_model_usage,
     estimate_tokens
 )
-from llm_utils import generate_summary, compress_message
+from tokenizer import count_tokens_batch, count_context_tokens
+from llm_utils import generate_summary, compress_message, cached_prompt_tokens, reasoning_tokens
+from models import primary_model
+from summary_worker import SummaryScheduler
+from retrieval import retrieve_passages, format_passages
+from metrics import timed, SUMMARY_CACHE, COMPRESSION_CACHE
 from config import (
     RECENT_MESSAGE_COUNT,
     SUMMARY_MAX_TOKENS,
+    SUMMARY_REFRESH_INTERVAL,
+    SUMMARY_TREE_FANOUT,
+    SUMMARY_NODE_MAX_TOKENS,
+    SUMMARY_BACKGROUND,
+    SUMMARY_WORKERS,
+    SUMMARY_MAX_LAG,
+    RETRIEVAL_ENABLED,
     MESSAGE_COMPRESS_THRESHOLD,
     MESSAGE_COMPRESSED_SIZE,
+    COMPRESSION_WORKERS,
+    COMPRESSION_DEADLINE,
+    TARGET_INPUT_TOKENS,
     MAX_INPUT_TOKENS,
-    STORY_SYSTEM_PROMPT
+    MESSAGE_TOKEN_OVERHEAD,
+    STORY_SYSTEM_PROMPT,
+    COMPRESS_PROMPT,
+    CONTEXT_LAYOUT,
+    SINGLE_FLIGHT_LEASE_TTL,
+    SINGLE_FLIGHT_POLL_INTERVAL
 )
 
-def compress_if_needed(message: Dict) -> Dict:
-    """Compress a message if it's too long"""
-    token_count = estimate_tokens(message['content'])
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    """One in-progress computation that other callers can wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Collapse concurrent calls with the same key into one computation.
+
+    The first caller for a key runs fn; callers arriving while it runs
+    wait and receive the same result (or exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: Dict[str, _Flight] = {}
+
+    def do(self, key: str, fn: Callable[[], object]):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+single_flight = SingleFlight()
+
+# Identifies this process on lease rows; the thread id is added per call
+_LEASE_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+# (lease_key, owner) of the lease this thread's compute runs under, if any
+_held_lease = threading.local()
+
+
+class LeaseLostError(RuntimeError):
+    """The lease expired mid-compute and another worker took it over"""
+
+
+def _renew_lease():
+    """Extend the lease held by this thread; raise LeaseLostError if it was lost.
+
+    Called around every LLM call of a leased compute, so long tree builds
+    keep their lease and a worker that lost it stops before writing.
+    """
+    held = getattr(_held_lease, "key", None)
+    if held is None:
+        return
+    lease_key, owner = held
+    if not acquire_lease(lease_key, owner, SINGLE_FLIGHT_LEASE_TTL):
+        raise LeaseLostError(f"Lease {lease_key} was taken over by another worker")
+
+
+def _run_leased(lease_key: str, lookup: Callable[[], Optional[str]], compute: Callable[[], str]) -> str:
+    """Run compute under a cross-process lease, unless lookup finds the result first.
+
+    While another worker holds the lease we poll lookup, so its result is
+    reused instead of paying for the same LLM call twice. An expired lease
+    (its holder crashed or hung) can be taken over; a holder that finds
+    its lease taken stops computing and waits for the new holder instead.
+    """
+    owner = f"{_LEASE_OWNER}:{threading.get_ident()}"
+    waited = False
+    
+    while True:
+        result = lookup()
+        if result is not None:
+            return result
+        
+        if acquire_lease(lease_key, owner, SINGLE_FLIGHT_LEASE_TTL):
+            _held_lease.key = (lease_key, owner)
+            try:
+                # The previous holder may have finished between our lookup and the lease
+                result = lookup() if waited else None
+                return result if result is not None else compute()
+            except LeaseLostError as e:
+                logger.warning(f"⚠️  {e}, waiting for its result")
+            finally:
+                _held_lease.key = None
+                release_lease(lease_key, owner)
+        
+        if not waited:
+            logger.info(f"⏳ Waiting for another worker on {lease_key}")
+            waited = True
+        time.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+
+
+def _content_hash(content: str) -> str:
+    """Stable hash of message content, used to detect changed rows"""
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def compression_settings_key() -> str:
+    """Identify the settings a compressed variant was produced with"""
+    prompt_hash = hashlib.sha256(COMPRESS_PROMPT.encode('utf-8')).hexdigest()[:12]
+    return f"{primary_model('compress')}:{MESSAGE_COMPRESSED_SIZE}:{prompt_hash}"
+
+
+def _record_usage(session_id: Optional[str], task: str, usage: Dict):
+    """Charge a summary or compression call to the session it was made for"""
+    if session_id is None or not usage.get("model"):
+        return   # No session to charge, or the call failed
+    record_model_usage(
+        session_id, usage["model"], task,
+        input_tokens=usage.get("prompt_tokens", 0),
+        output_tokens=usage.get("completion_tokens", 0),
+        cached_tokens=cached_prompt_tokens(usage),
+        reasoning_tokens=reasoning_tokens(usage)
+    )
+
+
+def _summarize(session_id: str, messages: List[Dict], max_tokens: int) -> str:
+    """generate_summary, with its usage charged to the session"""
+    _renew_lease()
+    usage = {}
+    summary = generate_summary(messages, max_tokens=max_tokens, usage=usage)
+    _record_usage(session_id, "summary", usage)
+    _renew_lease()   # Don't write a result another worker is now producing
+    return summary
+
+
+def fill_token_counts(messages: List[Dict], session_id: Optional[str] = None):
+    """Count tokens for messages without a cached count, and cache them (in the
+    session's cached state too, when session_id is given)"""
+    missing = [msg for msg in messages if msg.get('tokens') is None]
+    
+    if not missing:
+        return
+    
+    for msg, count in zip(missing, count_tokens_batch([msg['content'] for msg in missing])):
+        msg['tokens'] = count
+    
+    cache_token_counts([(msg['id'], msg['tokens']) for msg in missing if msg.get('id') is not None], session_id)
+
+
+def _chat_message(message: Dict) -> Dict:
+    """Strip bookkeeping fields before a message is sent to the provider"""
+    return {"role": message['role'], "content": message['content']}
+
+
+COMPRESSED_PREFIX = "[Previous scene, compressed]: "
+
+
+def compress_content(message: Dict, session_id: Optional[str] = None) -> str:
+    """Compressed text for a message, reusing cached compressions.
+
+    Concurrent requests for the same content, in this process or another
+    worker, share one compression call, charged to session_id.
+    """
+    message_id = message.get('id')
+    content_hash = _content_hash(message['content'])
+    settings_key = compression_settings_key()
+    
+    compressed_content = None
+    if message_id is not None:
+        compressed_content = get_compressed_message(message_id, content_hash, settings_key)
+        if compressed_content is not None:
+            COMPRESSION_CACHE.inc(result="hit")
+            logger.debug(f"♻️  Using cached compression for message {message_id}")
+    
+    if compressed_content is None:
+        def lookup():
+            cached = find_compressed_content(content_hash, settings_key)
+            if cached is not None:
+                COMPRESSION_CACHE.inc(result="shared")
+                if message_id is not None:
+                    cache_compressed_message(message_id, content_hash, settings_key, cached)
+            return cached
+        
+        def compute():
+            COMPRESSION_CACHE.inc(result="miss")
+            logger.debug(f"🔧 Compressing message: {message.get('tokens')} tokens → {MESSAGE_COMPRESSED_SIZE} tokens")
+            usage = {}
+            compressed = compress_message(message['content'], MESSAGE_COMPRESSED_SIZE, fallback=False, usage=usage)
+            _record_usage(session_id, "compress", usage)
+            _renew_lease()
+            if message_id is not None:
+                cache_compressed_message(message_id, content_hash, settings_key, compressed)
+            return compressed
+        
+        key = f"compress:{content_hash}:{settings_key}"
+        try:
+            compressed_content = single_flight.do(key, lambda: _run_leased(key, lookup, compute))
+        except Exception:
+            # Don't cache the truncation fallback, so a later turn retries
+            return _truncated_fallback(message)
+    
+    return f"{COMPRESSED_PREFIX}{compressed_content}"
+
+
+def _truncated_fallback(message: Dict) -> str:
+    """Stand-in for a compression that failed or took too long"""
+    return f"{COMPRESSED_PREFIX}{message['content'][:MESSAGE_COMPRESSED_SIZE * 4]}"
+
+
+# Shared by all requests, so total compression concurrency stays bounded
+_compression_pool = ThreadPoolExecutor(max_workers=max(1, COMPRESSION_WORKERS),
+                                       thread_name_prefix="compress")
+
+
+def compress_all(messages: List[Dict], deadline: float = COMPRESSION_DEADLINE, session_id: Optional[str] = None):
+    """Set message['compressed'] for each message, compressing in parallel.
+
+    Messages whose compression misses the deadline are truncated instead;
+    their LLM calls keep running and cache the result for a later turn.
+    """
+    if not messages:
+        return
+    
+    if len(messages) > 1:
+        logger.debug(f"🔧 Compressing {len(messages)} messages in parallel")
+    futures = [_compression_pool.submit(compress_content, message, session_id) for message in messages]
+    wait(futures, timeout=deadline)
+    
+    for message, future in zip(messages, futures):
+        if future.done():
+            message['compressed'] = future.result()
+        else:
+            logger.warning(f"⏱️  Compression of message {message.get('seq')} missed the {deadline:.0f}s deadline, truncating")
+            message['compressed'] = _truncated_fallback(message)
+
+
+def _attach_cached_compressions(messages: List[Dict]):
+    """Attach already-cached compressed variants so packing knows their real size"""
+    settings_key = compression_settings_key()
+    
+    for message in messages:
+        if message['tokens'] > MESSAGE_COMPRESS_THRESHOLD and message.get('id') is not None:
+            cached = get_compressed_message(message['id'], _content_hash(message['content']), settings_key)
+            if cached is not None:
+                message['compressed'] = f"{COMPRESSED_PREFIX}{cached}"
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text down to at most max_tokens"""
+    while text:
+        tokens = estimate_tokens(text)
+        if tokens <= max_tokens:
+            break
+        text = text[:max(0, len(text) * max(max_tokens, 0) // tokens - 1)]
+    return text
+
+
+def _full_cost(message: Dict) -> int:
+    return message['tokens'] + MESSAGE_TOKEN_OVERHEAD
+
+
+def _cheapest_cost(message: Dict) -> int:
+    """What the message costs if compressed when eligible (an upper bound until compressed)"""
+    if message['tokens'] <= MESSAGE_COMPRESS_THRESHOLD:
+        return _full_cost(message)
+    if 'compressed' in message:
+        return min(message['tokens'], estimate_tokens(message['compressed'])) + MESSAGE_TOKEN_OVERHEAD
+    compressed = MESSAGE_COMPRESSED_SIZE + estimate_tokens(COMPRESSED_PREFIX)
+    return min(message['tokens'], compressed) + MESSAGE_TOKEN_OVERHEAD
+
+
+def pack_context(head: List[Dict], messages: List[Dict], reserved_tokens: int = 0) -> tuple:
+    """Choose which messages fit TARGET_INPUT_TOKENS, and in which variant.
+
+    `head` (the summary/system message) always goes first; `messages` are
+    chronological with cached 'tokens'. Pass 1 keeps the longest run of
+    newest messages that fits the target when every message over
+    MESSAGE_COMPRESS_THRESHOLD is budgeted as compressed. Pass 2 spends
+    what is left of the target restoring full text, newest first, so
+    compression LLM calls only happen where the budget needs them.
+
+    Messages carrying a 'compressed' variant are budgeted at its real
+    size. Returns (selected, compress_flags, report). The hard limit is
+    enforced after compression by enforce_token_limit.
+    """
+    target = TARGET_INPUT_TOKENS - reserved_tokens
+    used = sum(_full_cost(msg) for msg in head)
+    
+    kept = 0
+    for message in reversed(messages):
+        cost = _cheapest_cost(message)
+        if kept > 0 and used + cost > target:
+            break
+        used += cost     # The newest message is always kept
+        kept += 1
+    
+    selected = messages[len(messages) - kept:]
+    compress_flags = [msg['tokens'] > MESSAGE_COMPRESS_THRESHOLD for msg in selected]
+    
+    for i in reversed(range(len(selected))):
+        if compress_flags[i]:
+            extra = _full_cost(selected[i]) - _cheapest_cost(selected[i])
+            if used + extra <= target:
+                compress_flags[i] = False
+                used += extra
     
-    if token_count > MESSAGE_COMPRESS_THRESHOLD:
-        print(f"🔧 Compressing message: {token_count} tokens → {MESSAGE_COMPRESSED_SIZE} tokens")
-        compressed_content = compress_message(message['content'], MESSAGE_COMPRESSED_SIZE)
-        return {
-            "role": message['role'],
-            "content": f"[Previous scene, compressed]: {compressed_content}"
+    report = {
+        "target_tokens": target,
+        "reserved_tokens": reserved_tokens,
+        "kept": [msg.get('seq') for msg in selected],
+        "compressed": [msg.get('seq') for msg, flag in zip(selected, compress_flags) if flag],
+        "dropped": [msg.get('seq') for msg in messages[:len(messages) - kept]],
+        "truncated": [],
+    }
+    
+    return selected, compress_flags, report
+
+
+class PromptTooLargeError(ValueError):
+    """The prompt alone leaves no room within MAX_INPUT_TOKENS"""
+
+
+def check_prompt_size(prompt: str) -> int:
+    """Tokens the prompt will take in the request; raises PromptTooLargeError if
+    it would not fit next to the system prompt within MAX_INPUT_TOKENS"""
+    tokens = estimate_tokens(prompt) + MESSAGE_TOKEN_OVERHEAD
+    available = MAX_INPUT_TOKENS - count_context_tokens([{"content": STORY_SYSTEM_PROMPT}])
+    if tokens > available:
+        raise PromptTooLargeError(f"Prompt is {tokens} tokens, at most {available} fit within "
+                                  f"the {MAX_INPUT_TOKENS}-token input limit")
+    return tokens
+
+
+def enforce_token_limit(head: List[Dict], messages: List[Dict], report: Dict, reserved_tokens: int = 0) -> tuple:
+    """Guarantee MAX_INPUT_TOKENS: drop oldest messages, then truncate what's left"""
+    limit = MAX_INPUT_TOKENS - reserved_tokens
+    total = count_context_tokens(head + messages)
+    
+    while total > limit and len(messages) > 1:
+        dropped = messages.pop(0)
+        report['dropped'].append(dropped.get('seq'))
+        report['kept'].remove(dropped.get('seq'))
+        total -= _full_cost(dropped)
+    
+    # Still over: shorten the last head messages (retrieved passages, then the
+    # summary), then the newest message itself; the system prompt stays whole
+    shortenable = [msg for msg in head if msg.get('label') != "system prompt"][-2:]
+    for message in shortenable[::-1] + messages[-1:]:
+        if total <= limit:
+            break
+        allowed = message['tokens'] - (total - limit)
+        message['content'] = _truncate_to_tokens(message['content'], allowed)
+        total -= message['tokens']
+        message['tokens'] = estimate_tokens(message['content'])
+        total += message['tokens']
+        report['truncated'].append(message.get('label', "newest message"))
+    
+    report['tokens'] = total
+    return head, messages
+
+
+def summary_coverage(total_messages: int) -> int:
+    """How many old messages the summary should cover.
+
+    Coverage only advances in steps of SUMMARY_REFRESH_INTERVAL, so the
+    recent window floats between RECENT_MESSAGE_COUNT and
+    RECENT_MESSAGE_COUNT + SUMMARY_REFRESH_INTERVAL - 1 messages and the
+    cached summary is reused until a whole chunk has aged out.
+    """
+    old_message_count = total_messages - RECENT_MESSAGE_COUNT
+    
+    if old_message_count <= 0:
+        return 0
+    
+    interval = max(1, SUMMARY_REFRESH_INTERVAL)
+    return (old_message_count // interval) * interval
+
+
+def _nodes_as_messages(nodes: List[Dict]) -> List[Dict]:
+    """Present summary tree nodes to the summarizer as conversation turns"""
+    return [
+        {"role": f"summary of messages {node['span_start']}-{node['span_end']}", "content": node['text']}
+        for node in nodes
+    ]
+
+
+def _nodes_cover(nodes: List[Dict], message_count: int) -> bool:
+    """True if the tree frontier summarizes exactly messages 1..message_count"""
+    if not nodes or nodes[0]['span_start'] != 1 or nodes[-1]['span_end'] != message_count:
+        return False
+    return all(prev['span_end'] + 1 == node['span_start'] for prev, node in zip(nodes, nodes[1:]))
+
+
+def _frontier_summary(nodes: List[Dict], message_count: int) -> Optional[str]:
+    """The tree frontier as summary text, if it covers 1..message_count within SUMMARY_MAX_TOKENS"""
+    if not _nodes_cover(nodes, message_count):
+        return None
+    text = "\n\n".join(node['text'] for node in nodes)
+    return text if estimate_tokens(text) <= SUMMARY_MAX_TOKENS else None
+
+
+def _compact_summary_tree(session_id: str, nodes: List[Dict]) -> List[Dict]:
+    """Merge the newest SUMMARY_TREE_FANOUT same-level nodes into a parent, repeatedly"""
+    fanout = max(2, SUMMARY_TREE_FANOUT)
+    
+    while len(nodes) >= fanout and len({node['level'] for node in nodes[-fanout:]}) == 1:
+        children = nodes[-fanout:]
+        parent = {
+            "level": children[0]['level'] + 1,
+            "span_start": children[0]['span_start'],
+            "span_end": children[-1]['span_end'],
         }
+        logger.debug(f"🌳 Merging {fanout} level-{children[0]['level']} summaries "
+                     f"({parent['span_start']}-{parent['span_end']})")
+        parent['text'] = _summarize(session_id, _nodes_as_messages(children), SUMMARY_NODE_MAX_TOKENS)
+        store_summary_node(session_id, parent, replaces=children)
+        nodes = nodes[:-fanout] + [parent]
     
-    return message
+    return nodes
+
+
+def _extend_summary_tree(session_id: str, target_coverage: int) -> tuple:
+    """Summarize messages up to target_coverage into the summary tree.
+
+    Returns (nodes, new_leaves): the frontier nodes covering messages
+    1..target_coverage, and the leaf nodes written by this call.
+    """
+    nodes = get_summary_nodes(session_id)
+    
+    # Seed the tree from an older flat summary instead of re-reading history
+    if not nodes:
+        latest = get_latest_cached_summary(session_id)
+        if latest and latest[0] <= target_coverage:
+            seed = {"level": 1, "span_start": 1, "span_end": latest[0], "text": latest[1]}
+            store_summary_node(session_id, seed)
+            nodes = [seed]
+    
+    covered = nodes[-1]['span_end'] if nodes else 0
+    new_leaves = []
+    
+    while covered < target_coverage:
+        end = min(covered + max(1, SUMMARY_REFRESH_INTERVAL), target_coverage)
+        logger.debug(f"📝 Generating incremental summary for messages {covered + 1}-{end}")
+        leaf = {
+            "level": 1,
+            "span_start": covered + 1,
+            "span_end": end,
+            "text": _summarize(session_id, get_messages_range(session_id, covered + 1, end), SUMMARY_NODE_MAX_TOKENS),
+        }
+        store_summary_node(session_id, leaf)
+        new_leaves.append(leaf)
+        nodes = _compact_summary_tree(session_id, nodes + [leaf])
+        covered = end
+    
+    if covered > target_coverage:
+        # The tree is already past the target (e.g. history was trimmed):
+        # keep the nodes inside it and summarize the remainder directly
+        nodes = [node for node in nodes if node['span_end'] <= target_coverage]
+        tail_start = nodes[-1]['span_end'] + 1 if nodes else 1
+        if tail_start <= target_coverage:
+            tail = get_messages_range(session_id, tail_start, target_coverage)
+            nodes.append({
+                "level": 1,
+                "span_start": tail_start,
+                "span_end": target_coverage,
+                "text": _summarize(session_id, tail, SUMMARY_NODE_MAX_TOKENS),
+            })
+    
+    return nodes, new_leaves
 
 
 def generate_summary_incremental(session_id: str, target_coverage: int) -> str:
@@ -39,94 +539,201 @@ def generate_summary_incremental(session_id: str, target_coverage: int) -> str:
     # Check if we have a previous summary to build on
     latest = get_latest_cached_summary(session_id)
     
-    if latest:
-        prev_coverage, prev_summary = latest
-        
-        # If we already have summary for this coverage, return it
-        if prev_coverage >= target_coverage:
-            return prev_summary
-        
-        # Generate incremental summary for new messages
-        new_messages = get_messages_range(session_id, prev_coverage + 1, target_coverage)
-        
-        if new_messages:
-            print(f"📝 Generating incremental summary for messages {prev_coverage + 1}-{target_coverage}")
-            new_summary_part = generate_summary(new_messages, max_tokens=1000)
-            
-            # Combine summaries
-            combined = f"{prev_summary}\n\nRecent developments: {new_summary_part}"
-            
-            # If combined is too long, re-summarize
-            if estimate_tokens(combined) > SUMMARY_MAX_TOKENS:
-                print("🔄 Combined summary too long, re-summarizing...")
-                all_messages = get_messages_range(session_id, 1, target_coverage)
-                combined = generate_summary(all_messages, SUMMARY_MAX_TOKENS)
-            
+    # If we already have summary for this coverage, return it
+    if latest and latest[0] >= target_coverage:
+        return latest[1]
+    
+    nodes, new_leaves = _extend_summary_tree(session_id, target_coverage)
+    
+    # Cheap path: append the new leaf summaries to the previous summary
+    if latest and new_leaves and new_leaves[0]['span_start'] == latest[0] + 1:
+        new_parts = "\n\n".join(leaf['text'] for leaf in new_leaves)
+        combined = f"{latest[1]}\n\nRecent developments: {new_parts}"
+        if estimate_tokens(combined) <= SUMMARY_MAX_TOKENS:
             return combined
-        else:
-            return prev_summary
-    else:
-        # No previous summary, generate from scratch
-        print(f"📝 Generating summary for messages 1-{target_coverage}")
-        messages = get_messages_range(session_id, 1, target_coverage)
-        summary = generate_summary(messages, SUMMARY_MAX_TOKENS)
+        logger.debug("🔄 Combined summary too long, re-summarizing from summary tree...")
+    
+    # Rebuild from the tree frontier: O(log n) nodes rather than all messages.
+    # Only a frontier over budget needs the LLM, and that is also exactly when
+    # the cache_friendly layout sends this summary instead of the frontier
+    combined = _frontier_summary(nodes, target_coverage)
+    if combined is None:
+        combined = _summarize(session_id, _nodes_as_messages(nodes), SUMMARY_MAX_TOKENS)
+    
+    return combined
+
+
+def ensure_summary(session_id: str, target_coverage: int) -> str:
+    """Get the summary for target_coverage, generating and caching it if missing.
+
+    Concurrent callers share one generation: per (session, coverage) within
+    this process, and per session across worker processes, since every
+    generation extends the same summary tree.
+    """
+    summary = get_cached_summary(session_id, target_coverage)
+    if summary is not None:
+        return summary
+    
+    def compute():
+        summary = generate_summary_incremental(session_id, target_coverage)
+        cache_summary(session_id, target_coverage, summary)
         return summary
+    
+    return single_flight.do(
+        f"summary:{session_id}:{target_coverage}",
+        lambda: _run_leased(f"summary:{session_id}",
+                            lambda: get_cached_summary(session_id, target_coverage), compute)
+    )
 
 
-def build_context(session_id: str, current_prompt: str) -> List[Dict]:
-    """Build context for the LLM request"""
-    total_messages = count_messages(session_id)
+# Precomputes summaries between turns; started and stopped by main.py
+summary_scheduler = SummaryScheduler(ensure_summary, SUMMARY_WORKERS)
+
+
+def schedule_summary_refresh(session_id: str, upcoming_messages: int = 0):
+    """Precompute the summary the next turn will need, in the background.
+
+    A turn builds its context before its prompt is stored, so by default
+    the next turn needs the coverage of the messages stored now.
+    """
+    if not (SUMMARY_BACKGROUND and summary_scheduler.running):
+        return
     
-    print(f"\n📊 Building context: {total_messages} total messages")
+    target_coverage = summary_coverage(count_messages(session_id) + upcoming_messages)
     
-    # PHASE 1: Short conversations - send everything
-    if total_messages <= RECENT_MESSAGE_COUNT:
-        print(f"✅ Short conversation, sending all {total_messages} messages")
-        messages = get_all_messages(session_id)
+    if target_coverage > 0 and get_cached_summary(session_id, target_coverage) is None:
+        summary_scheduler.schedule(session_id, target_coverage)
+
+
+def build_context_with_report(session_id: str, current_prompt: str) -> tuple:
+    """Build context for the LLM request, plus a report of what was packed"""
+    # Read everything from one consistent snapshot (in memory for hot sessions);
+    # LLM work happens after
+    with timed("db_read"):
+        state = get_session_state(session_id)
+        total_messages = state.message_count
+        old_message_count = summary_coverage(total_messages)
+        summary = None
+        summary_nodes = []
+        summary_result = None
         
-        # Compress any long messages
-        messages = [compress_if_needed(msg) for msg in messages]
+        if old_message_count > 0:
+            summary = state.summaries.get(old_message_count)
+            if summary is None:
+                summary = get_cached_summary(session_id, old_message_count)
+            summary_result = "hit" if summary is not None else "miss"
+            
+            # Fall back to the freshest completed summary (or none at all) while
+            # the background worker catches up, as long as it isn't too stale
+            if summary is None and SUMMARY_BACKGROUND and summary_scheduler.running:
+                latest = state.latest_summary()
+                latest_coverage = latest[0] if latest else 0
+                if 0 < old_message_count - latest_coverage <= SUMMARY_MAX_LAG:
+                    summary_scheduler.schedule(session_id, old_message_count)
+                    logger.info(f"⏳ Summary for {old_message_count} messages scheduled, using {latest_coverage}")
+                    old_message_count, summary = latest if latest else (0, None)
+                    summary_result = "stale"
         
-        return messages
+        window = state.messages_from(old_message_count + 1)
+        if window is None:
+            # Older than the cached window (e.g. a stale summary far behind)
+            window = get_messages_range(session_id, old_message_count + 1, total_messages)
+        if old_message_count > 0 and CONTEXT_LAYOUT == "cache_friendly" and summary is not None:
+            summary_nodes = state.summary_nodes()
     
-    # PHASE 2: Long conversations - summarize old, keep recent
-    old_message_count = total_messages - RECENT_MESSAGE_COUNT
-    print(f"📦 Long conversation: {old_message_count} old + {RECENT_MESSAGE_COUNT} recent")
+    if summary_result:
+        SUMMARY_CACHE.inc(result=summary_result)
+    logger.debug(f"📊 Building context: {total_messages} total messages")
     
-    # Get or create summary for old messages
-    summary = get_cached_summary(session_id, old_message_count)
+    fill_token_counts(window, session_id)
     
-    if not summary:
-        print(f"🔨 Generating new summary for {old_message_count} messages...")
-        summary = generate_summary_incremental(session_id, old_message_count)
-        cache_summary(session_id, old_message_count, summary)
-        print("✅ Summary cached")
+    head = []
+    passages = []
+    if old_message_count == 0:
+        # PHASE 1: Short conversations - send everything that fits
+        logger.debug(f"✅ Short conversation, {total_messages} messages")
     else:
-        print(f"♻️  Using cached summary for {old_message_count} messages")
+        # PHASE 2: Long conversations - summarize old, keep recent
+        logger.debug(f"📦 Long conversation: {old_message_count} old + {len(window)} recent")
+        
+        # Get or create summary for old messages
+        if not summary:
+            logger.debug(f"🔨 Generating new summary for {old_message_count} messages...")
+            with timed("summary"):
+                summary = ensure_summary(session_id, old_message_count)
+            logger.debug("✅ Summary cached")
+            if CONTEXT_LAYOUT == "cache_friendly":
+                summary_nodes = get_summary_nodes(session_id)
+        else:
+            logger.debug(f"♻️  Using cached summary for {old_message_count} messages")
+        
+        if CONTEXT_LAYOUT == "cache_friendly":
+            # Stable prefix: the system prompt alone, then the summary tree's
+            # frozen nodes oldest first, which only change at the tail. A
+            # frontier over SUMMARY_MAX_TOKENS is replaced by the level-0 summary
+            if STORY_SYSTEM_PROMPT.strip():
+                head.append({"role": "system", "content": STORY_SYSTEM_PROMPT,
+                             "tokens": estimate_tokens(STORY_SYSTEM_PROMPT), "label": "system prompt"})
+            summary = _frontier_summary(summary_nodes, old_message_count) or summary
+            system_content = f"Story so far: {summary}"
+        else:
+            system_content = f"{STORY_SYSTEM_PROMPT}\n\nStory so far: {summary}"
+        head.append({"role": "system", "content": system_content,
+                     "tokens": estimate_tokens(system_content), "label": "summary"})
+        
+        # Bring back archived scenes relevant to this prompt
+        if RETRIEVAL_ENABLED:
+            with timed("retrieval"):
+                passages = retrieve_passages(session_id, current_prompt, old_message_count)
+        if passages:
+            logger.debug(f"🔎 Retrieved {len(passages)} earlier passages: {[msg['seq'] for msg in passages]}")
+            passages_content = f"Relevant earlier passages:\n\n{format_passages(passages)}"
+            head.append({"role": "system", "content": passages_content,
+                         "tokens": estimate_tokens(passages_content), "label": "retrieved passages"})
     
-    # Get recent messages
-    recent_messages = get_last_n_messages(session_id, RECENT_MESSAGE_COUNT)
+    # Fit the window to the token budget; the current prompt is appended later
+    reserved_tokens = check_prompt_size(current_prompt)
+    _attach_cached_compressions(window)
     
-    # Compress long recent messages
-    recent_messages = [compress_if_needed(msg) for msg in recent_messages]
+    # Fresh compressions come in under their budgeted upper bound, so if
+    # anything was dropped, pack once more with the real sizes
+    for _ in range(2):
+        selected, compress_flags, report = pack_context(head, window, reserved_tokens)
+        pending = [msg for msg, flag in zip(selected, compress_flags) if flag and 'compressed' not in msg]
+        if pending:
+            with timed("compression"):
+                compress_all(pending, session_id=session_id)
+        if not pending or not report['dropped']:
+            break
     
-    # Build final context
-    context = [
-        {"role": "system", "content": f"{STORY_SYSTEM_PROMPT}\n\nStory so far: {summary}"}
-    ]
-    context.extend(recent_messages)
-    
-    # Estimate total tokens
-    total_tokens = sum(estimate_tokens(msg['content']) for msg in context)
-    print(f"📏 Total context tokens: ~{total_tokens}")
-    
-    # Safety check
-    if total_tokens > MAX_INPUT_TOKENS:
-        print("⚠️  Context exceeds limit! Applying emergency truncation...")
-        # Emergency: keep only last 10 messages + summary
-        context = [
-            {"role": "system", "content": f"{STORY_SYSTEM_PROMPT}\n\nStory so far: {summary}"}
-        ]
-        context.extend(recent_messages[-10:])
-    
-    return context
\ No newline at end of file
+    packed = []
+    for message, compress in zip(selected, compress_flags):
+        if compress:
+            message = {**message, "content": message['compressed'], "tokens": estimate_tokens(message['compressed'])}
+        packed.append(dict(message))
+    
+    report['retrieved'] = [msg['seq'] for msg in passages]
+    head, packed = enforce_token_limit(head, packed, report, reserved_tokens)
+    
+    logger.info(f"📏 Total context tokens: ~{report['tokens']} (target {report['target_tokens']}), "
+                f"{len(report['kept'])} kept, {len(report['compressed'])} compressed, "
+                f"{len(report['dropped'])} dropped")
+    if report['truncated']:
+        logger.warning(f"⚠️  Context exceeded limit, truncated: {', '.join(report['truncated'])}")
+    
+    if CONTEXT_LAYOUT == "cache_friendly":
+        # Per-turn material goes last so everything before it stays a cacheable prefix
+        fixed = [msg for msg in head if msg.get('label') != "retrieved passages"]
+        varying = [msg for msg in head if msg.get('label') == "retrieved passages"]
+        ordered = fixed + packed + varying
+    else:
+        ordered = head + packed
+    
+    context = [_chat_message(msg) for msg in ordered]
+    return context, report
+
+
+def build_context(session_id: str, current_prompt: str) -> List[Dict]:
+    """Build context for the LLM request"""
+    context, _ = build_context_with_report(session_id, current_prompt)
+    return context
@@ -1,258 +1,1470 @@
+import logging
 import sqlite3
-from typing import List, Dict, Optional
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Dict, Optional, Iterator
 from datetime import datetime
-from config import DB_NAME
+from config import (
+    DB_NAME,
+    DB_BUSY_TIMEOUT,
+    DB_MMAP_SIZE,
+    DB_STATEMENT_CACHE_SIZE,
+    RECENT_MESSAGE_COUNT,
+    SUMMARY_REFRESH_INTERVAL,
+    SUMMARY_MAX_LAG,
+    SESSION_CACHE_MAX_BYTES,
+    SESSION_CACHE_VALIDATE,
+    STORAGE_COMPRESSION,
+    STORAGE_COMPRESS_MIN_BYTES,
+    STORAGE_COMPRESSION_LEVEL,
+    STORAGE_DICT_SAMPLE_BYTES,
+    STORAGE_DICT_MIN_SAMPLE
+)
+from metrics import SESSION_STATE_CACHE
+from models import primary_model, usage_cost
+from session_cache import SessionCache, SessionState
+from text_codec import TextCodec, train_dictionary
+from tokenizer import count_tokens, get_counter
 
 
-def init_database():
-    """Initialize SQLite database"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
-    cursor = conn.cursor()
-    
-    # Messages table - stores all messages in full
+logger = logging.getLogger(__name__)
+
+
+# Connection manager - one long-lived connection per thread
+_local = threading.local()
+_connections = set()
+_connections_lock = threading.Lock()
+
+# Called with every SQL statement run on any connection, when set
+_query_tracer = None
+
+# Hot session state, updated after every committed write (see get_session_state).
+# Holds enough recent messages for the widest window build_context reads.
+session_cache = SessionCache(
+    SESSION_CACHE_MAX_BYTES, RECENT_MESSAGE_COUNT + SUMMARY_REFRESH_INTERVAL + SUMMARY_MAX_LAG
+)
+
+
+def _load_dictionary(dict_id: int) -> Optional[bytes]:
+    """A compression dictionary by id (one trained by another process, say)"""
+    row = get_connection().execute(
+        'SELECT zdict FROM compression_dicts WHERE dict_id = ?', (dict_id,)
+    ).fetchone()
+    return row[0] if row else None
+
+
+# Message content and summary text are stored through this (see text_codec.py).
+# Values are decoded as rows are read, so only rows a query returns pay for it.
+text_codec = TextCodec(
+    STORAGE_COMPRESSION_LEVEL, STORAGE_COMPRESS_MIN_BYTES, STORAGE_COMPRESSION, _load_dictionary
+)
+
+
+def _open_connection() -> sqlite3.Connection:
+    """Open and tune a new SQLite connection"""
+    conn = sqlite3.connect(
+        DB_NAME,
+        timeout=DB_BUSY_TIMEOUT,
+        isolation_level=None,                   # Transactions are managed explicitly
+        cached_statements=DB_STATEMENT_CACHE_SIZE,
+        check_same_thread=False                 # Only closed cross-thread, at shutdown
+    )
+    # Only takes effect on a new, empty file (so before switching to WAL);
+    # existing databases switch with a full VACUUM (maintenance.py vacuum --full)
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA mmap_size={int(DB_MMAP_SIZE)}')
+    # Lets SQL see stored text as written, e.g. for full-text index deletes
+    conn.create_function('decode_text', 1, text_codec.decode, deterministic=True)
+
+    with _connections_lock:
+        conn.set_trace_callback(_query_tracer)
+        _connections.add(conn)
+
+    return conn
+
+
+def get_connection() -> sqlite3.Connection:
+    """Get this thread's connection, opening it on first use"""
+    conn = getattr(_local, 'conn', None)
+
+    if conn is None:
+        conn = _open_connection()
+        _local.conn = conn
+        _local.depth = 0
+        _local.after_commit = []
+
+    return conn
+
+
+def set_query_tracer(callback):
+    """Call callback(sql) for every statement on every connection (None to stop)"""
+    global _query_tracer
+
+    with _connections_lock:
+        _query_tracer = callback
+        for conn in _connections:
+            conn.set_trace_callback(callback)
+
+
+def close_all_connections():
+    """Close every connection opened by this process (call on shutdown)"""
+    with _connections_lock:
+        connections = list(_connections)
+        _connections.clear()
+
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    _local.conn = None
+    _local.depth = 0
+    _local.after_commit = []
+
+
+@contextmanager
+def transaction(immediate: bool = False) -> Iterator[sqlite3.Connection]:
+    """Unit of work: everything inside commits or rolls back together.
+
+    Reads inside one transaction see a single consistent snapshot. Use
+    immediate=True for writes to take the write lock up front. Nested
+    calls become savepoints of the outermost transaction.
+    """
+    conn = get_connection()
+    depth = _local.depth
+    savepoint = f"sp_{depth}"
+
+    if depth == 0:
+        conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+    else:
+        conn.execute(f'SAVEPOINT {savepoint}')
+    _local.depth = depth + 1
+
+    try:
+        yield conn
+    except BaseException:
+        _local.depth = depth
+        # Callbacks for writes that were just rolled back must not run
+        _local.after_commit = [(level, fn) for level, fn in _local.after_commit if level <= depth]
+        if depth == 0:
+            conn.execute('ROLLBACK')
+        else:
+            conn.execute(f'ROLLBACK TO {savepoint}')
+            conn.execute(f'RELEASE {savepoint}')
+        raise
+
+    _local.depth = depth
+    if depth == 0:
+        callbacks, _local.after_commit = _local.after_commit, []
+        try:
+            conn.execute('COMMIT')
+        except BaseException:
+            # e.g. SQLITE_BUSY or a disk error: don't leave the pooled
+            # connection inside the failed transaction
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        for _, callback in callbacks:
+            callback()
+    else:
+        conn.execute(f'RELEASE {savepoint}')
+
+
+def after_commit(callback):
+    """Run callback once the current transaction commits (at once outside one)"""
+    get_connection()
+    if _local.depth == 0:
+        callback()
+    else:
+        _local.after_commit.append((_local.depth, callback))
+
+
+SCHEMA_VERSION = 8
+
+# Upserts need 3.24, window functions (the v1 migration) 3.25
+MIN_SQLITE_VERSION = (3, 25, 0)
+
+
+def _table_columns(cursor: sqlite3.Cursor, table: str) -> List[str]:
+    """Column names of a table"""
+    return [row[1] for row in cursor.execute(f'PRAGMA table_info({table})').fetchall()]
+
+
+def _migrate(cursor: sqlite3.Cursor):
+    """Bring an existing database up to SCHEMA_VERSION"""
+    version = cursor.execute('PRAGMA user_version').fetchone()[0]
+
+    if version < 1:
+        # v1: per-session message ordinal (seq) replaces timestamp ordering
+        if 'seq' not in _table_columns(cursor, 'messages'):
+            cursor.execute('ALTER TABLE messages ADD COLUMN seq INTEGER')
+        # Through a temp table rather than UPDATE ... FROM (SQLite 3.33+)
+        cursor.execute('CREATE TEMP TABLE seq_backfill (id INTEGER PRIMARY KEY, rn INTEGER NOT NULL)')
+        cursor.execute('''
+            INSERT INTO seq_backfill (id, rn)
+            SELECT id, ROW_NUMBER() OVER (
+                PARTITION BY session_id ORDER BY timestamp, id
+            )
+            FROM messages
+        ''')
+        cursor.execute('''
+            UPDATE messages SET seq = (SELECT rn FROM seq_backfill WHERE seq_backfill.id = messages.id)
+            WHERE seq IS NULL
+        ''')
+        cursor.execute('DROP TABLE seq_backfill')
+
+    if version < 2:
+        # v2: summaries gain a tree level and span start; existing rows are
+        # the level-0 "story so far" summaries starting at message 1
+        if 'level' not in _table_columns(cursor, 'summaries'):
+            cursor.execute('''
+                CREATE TABLE summaries_v2 (
+                    session_id TEXT NOT NULL,
+                    level INTEGER NOT NULL DEFAULT 0,
+                    span_start INTEGER NOT NULL DEFAULT 1,
+                    messages_covered INTEGER NOT NULL,
+                    summary_text TEXT NOT NULL,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (session_id, level, messages_covered)
+                )
+            ''')
+            cursor.execute('''
+                INSERT INTO summaries_v2 (session_id, level, span_start, messages_covered, summary_text, created_at)
+                SELECT session_id, 0, 1, messages_covered, summary_text, created_at FROM summaries
+            ''')
+            cursor.execute('DROP TABLE summaries')
+            cursor.execute('ALTER TABLE summaries_v2 RENAME TO summaries')
+
+    if version < 3:
+        # v3: cached token counts per message (filled lazily for old rows)
+        columns = _table_columns(cursor, 'messages')
+        if 'token_count' not in columns:
+            cursor.execute('ALTER TABLE messages ADD COLUMN token_count INTEGER')
+        if 'token_counter' not in columns:
+            cursor.execute('ALTER TABLE messages ADD COLUMN token_counter TEXT')
+
+    if version < 4:
+        # v4: prompt tokens the provider served from its prefix cache
+        if 'cached_tokens' not in _table_columns(cursor, 'messages'):
+            cursor.execute('ALTER TABLE messages ADD COLUMN cached_tokens INTEGER DEFAULT 0')
+
+    if version < 5:
+        # v5: output tokens spent on hidden reasoning (part of output_tokens)
+        if 'reasoning_tokens' not in _table_columns(cursor, 'messages'):
+            cursor.execute('ALTER TABLE messages ADD COLUMN reasoning_tokens INTEGER DEFAULT 0')
+
+    if version < 6:
+        # v6: per-session aggregates, from here on maintained by triggers
+        cursor.execute('DELETE FROM sessions')
+        cursor.execute('''
+            INSERT INTO sessions (session_id, message_count, input_tokens, output_tokens,
+                                  cached_tokens, reasoning_tokens, last_activity)
+            SELECT session_id, COUNT(*), COALESCE(SUM(input_tokens), 0), COALESCE(SUM(output_tokens), 0),
+                   COALESCE(SUM(cached_tokens), 0), COALESCE(SUM(reasoning_tokens), 0), MAX(timestamp)
+            FROM messages
+            GROUP BY session_id
+        ''')
+        cursor.execute('''
+            UPDATE sessions SET summary_count = (
+                SELECT COUNT(*) FROM summaries
+                WHERE summaries.session_id = sessions.session_id AND summaries.level = 0
+            )
+        ''')
+
+    if version < 7:
+        # v7: content may be rewritten in place by the storage encoding
+        # migration, so it no longer drops compressed variants (which are
+        # checked against the content hash when read anyway)
+        cursor.execute('DROP TRIGGER IF EXISTS trg_messages_update_compressed')
+
+    if version < 8:
+        # v8: per-model usage ledger; earlier chat usage is attributed to the
+        # default chat model
+        _backfill_chat_usage(cursor)
+
+    if version < SCHEMA_VERSION:
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        logger.info(f"🔧 Database migrated to schema v{SCHEMA_VERSION}")
+
+
+def _backfill_chat_usage(cursor: sqlite3.Cursor, session_ids: Optional[List[str]] = None):
+    """Ledger rows for the chat usage of sessions (default: all) without any
+    ledger rows, charged to the default chat model"""
+    sql = '''
+        INSERT OR IGNORE INTO model_usage (session_id, model, task, calls, input_tokens, output_tokens,
+                                           cached_tokens, reasoning_tokens)
+        SELECT session_id, ?, 'chat', message_count / 2, input_tokens, output_tokens,
+               cached_tokens, reasoning_tokens
+        FROM sessions
+        WHERE session_id NOT IN (SELECT session_id FROM model_usage)
+    '''
+    if session_ids is None:
+        cursor.execute(sql, (primary_model("chat"),))
+    else:
+        cursor.executemany(sql + ' AND session_id = ?',
+                           [(primary_model("chat"), session_id) for session_id in session_ids])
+
+
+def backfill_chat_usage(session_ids: List[str]):
+    """Charge the chat usage of imported sessions that brought no usage records
+    (files exported before the ledger existed) to the default chat model"""
+    with transaction(immediate=True) as conn:
+        _backfill_chat_usage(conn.cursor(), session_ids)
+
+
+def _init_session_triggers(cursor: sqlite3.Cursor):
+    """Triggers that keep the sessions aggregates current.
+
+    Created after _migrate: they refer to token columns that older
+    databases only gain during migration, and SQLite re-checks every
+    trigger when a migration step renames a table.
+    """
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT NOT NULL,
-            role TEXT NOT NULL,
-            content TEXT NOT NULL,
-            input_tokens INTEGER DEFAULT 0,
-            output_tokens INTEGER DEFAULT 0,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
+        CREATE TRIGGER IF NOT EXISTS trg_messages_insert_sessions
+        AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO sessions (session_id, message_count, input_tokens, output_tokens,
+                                  cached_tokens, reasoning_tokens, last_activity)
+            VALUES (NEW.session_id, 1, COALESCE(NEW.input_tokens, 0), COALESCE(NEW.output_tokens, 0),
+                    COALESCE(NEW.cached_tokens, 0), COALESCE(NEW.reasoning_tokens, 0), NEW.timestamp)
+            ON CONFLICT (session_id) DO UPDATE SET
+                message_count = message_count + 1,
+                input_tokens = input_tokens + excluded.input_tokens,
+                output_tokens = output_tokens + excluded.output_tokens,
+                cached_tokens = cached_tokens + excluded.cached_tokens,
+                reasoning_tokens = reasoning_tokens + excluded.reasoning_tokens,
+                last_activity = MAX(COALESCE(last_activity, ''), excluded.last_activity);
+        END
     ''')
-    
-    # Summaries table - caches summaries for old messages
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS summaries (
-            session_id TEXT NOT NULL,
-            messages_covered INTEGER NOT NULL,
-            summary_text TEXT NOT NULL,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (session_id, messages_covered)
-        )
+        CREATE TRIGGER IF NOT EXISTS trg_messages_update_sessions
+        AFTER UPDATE OF input_tokens, output_tokens, cached_tokens, reasoning_tokens ON messages
+        BEGIN
+            UPDATE sessions SET
+                input_tokens = input_tokens + COALESCE(NEW.input_tokens, 0) - COALESCE(OLD.input_tokens, 0),
+                output_tokens = output_tokens + COALESCE(NEW.output_tokens, 0) - COALESCE(OLD.output_tokens, 0),
+                cached_tokens = cached_tokens + COALESCE(NEW.cached_tokens, 0) - COALESCE(OLD.cached_tokens, 0),
+                reasoning_tokens = reasoning_tokens + COALESCE(NEW.reasoning_tokens, 0) - COALESCE(OLD.reasoning_tokens, 0)
+            WHERE session_id = NEW.session_id;
+        END
     ''')
-    
-    # Create indexes
-    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_session_timestamp 
-                     ON messages(session_id, timestamp DESC)''')
-    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_summary_session 
-                     ON summaries(session_id, messages_covered DESC)''')
-    
-    conn.commit()
-    conn.close()
-    print("✅ Database initialized successfully")
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_delete_sessions
+        AFTER DELETE ON messages
+        BEGIN
+            UPDATE sessions SET
+                message_count = message_count - 1,
+                input_tokens = input_tokens - COALESCE(OLD.input_tokens, 0),
+                output_tokens = output_tokens - COALESCE(OLD.output_tokens, 0),
+                cached_tokens = cached_tokens - COALESCE(OLD.cached_tokens, 0),
+                reasoning_tokens = reasoning_tokens - COALESCE(OLD.reasoning_tokens, 0),
+                last_activity = (SELECT MAX(timestamp) FROM messages WHERE session_id = OLD.session_id)
+            WHERE session_id = OLD.session_id;
+            DELETE FROM sessions WHERE session_id = OLD.session_id AND message_count <= 0;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_summaries_insert_sessions
+        AFTER INSERT ON summaries WHEN NEW.level = 0
+        BEGIN
+            UPDATE sessions SET summary_count = summary_count + 1 WHERE session_id = NEW.session_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_summaries_delete_sessions
+        AFTER DELETE ON summaries WHEN OLD.level = 0
+        BEGIN
+            UPDATE sessions SET summary_count = summary_count - 1 WHERE session_id = OLD.session_id;
+        END
+    ''')
+
+
+# Set by init_database once the FTS5 search index is known to exist
+SEARCH_AVAILABLE = False
+
+
+def _init_search_index(cursor: sqlite3.Cursor):
+    """Create the contentless FTS5 index, backfilling it the first time.
+
+    The index stores no copy of the text (content=''): rows are added and
+    removed from Python alongside the messages they mirror, keyed by
+    message id.
+    """
+    global SEARCH_AVAILABLE
+
+    exists = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+    ).fetchone()
+
+    try:
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+            USING fts5(content, session_id, content='', tokenize='porter unicode61')
+        ''')
+    except sqlite3.OperationalError as e:
+        logger.warning(f"⚠️  Full-text search unavailable ({e}), retrieval disabled")
+        SEARCH_AVAILABLE = False
+        return
+
+    if not exists:
+        cursor.execute('''
+            INSERT INTO messages_fts (rowid, content, session_id)
+            SELECT id, decode_text(content), session_id FROM messages
+        ''')
+        logger.info("🔎 Built full-text index over existing messages")
+
+    SEARCH_AVAILABLE = True
+
+
+def init_database():
+    """Initialize SQLite database"""
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        raise RuntimeError(f"SQLite {sqlite3.sqlite_version} is too old, "
+                           f"{'.'.join(map(str, MIN_SQLITE_VERSION))} or newer is required")
+
+    with transaction(immediate=True) as conn:
+        cursor = conn.cursor()
+
+        # Messages table - stores all messages in full
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                seq INTEGER,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                input_tokens INTEGER DEFAULT 0,
+                output_tokens INTEGER DEFAULT 0,
+                cached_tokens INTEGER DEFAULT 0,
+                reasoning_tokens INTEGER DEFAULT 0,
+                token_count INTEGER,
+                token_counter TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Summaries table - caches summaries for old messages. Level 0 rows are
+        # the "story so far" for messages 1..messages_covered; level >= 1 rows
+        # are summary tree nodes for span_start..messages_covered
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS summaries (
+                session_id TEXT NOT NULL,
+                level INTEGER NOT NULL DEFAULT 0,
+                span_start INTEGER NOT NULL DEFAULT 1,
+                messages_covered INTEGER NOT NULL,
+                summary_text TEXT NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (session_id, level, messages_covered)
+            )
+        ''')
+
+        # Compressed variants of long messages, keyed by source row, content hash
+        # and compression settings so recent messages are compressed at most once
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS compressed_messages (
+                message_id INTEGER NOT NULL,
+                content_hash TEXT NOT NULL,
+                settings_key TEXT NOT NULL,
+                compressed_text TEXT NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (message_id, settings_key)
+            )
+        ''')
+
+        # Drop compressed variants when the source row disappears
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_messages_delete_compressed
+            AFTER DELETE ON messages
+            BEGIN
+                DELETE FROM compressed_messages WHERE message_id = OLD.id;
+            END
+        ''')
+
+        # Per-session aggregates, so listing and stats don't scan messages.
+        # Kept current by triggers (see _init_session_triggers), in the same
+        # transaction as the change that caused them
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                input_tokens INTEGER NOT NULL DEFAULT 0,
+                output_tokens INTEGER NOT NULL DEFAULT 0,
+                cached_tokens INTEGER NOT NULL DEFAULT 0,
+                reasoning_tokens INTEGER NOT NULL DEFAULT 0,
+                summary_count INTEGER NOT NULL DEFAULT 0,
+                last_activity DATETIME
+            )
+        ''')
+
+        # Token buckets for the rate limiter, shared by all worker processes
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS rate_limits (
+                bucket_key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+
+        # Leases so only one worker process generates a given summary or compression
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS leases (
+                lease_key TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+
+        # Preset dictionaries for stored text, kept forever so old rows still decode
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS compression_dicts (
+                dict_id INTEGER PRIMARY KEY,
+                zdict BLOB NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # LLM spend per session, model and task (chat, summary, compress).
+        # Unlike the sessions aggregates it keeps the usage of turns deleted later
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS model_usage (
+                session_id TEXT NOT NULL,
+                model TEXT NOT NULL,
+                task TEXT NOT NULL,
+                calls INTEGER NOT NULL DEFAULT 0,
+                input_tokens INTEGER NOT NULL DEFAULT 0,
+                output_tokens INTEGER NOT NULL DEFAULT 0,
+                cached_tokens INTEGER NOT NULL DEFAULT 0,
+                reasoning_tokens INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (session_id, model, task)
+            )
+        ''')
+
+        # Upgrade databases created by older versions
+        _migrate(cursor)
+        _init_session_triggers(cursor)
+        use_latest_dictionary()
+
+        # Full-text index over message content (skipped if FTS5 is missing)
+        _init_search_index(cursor)
+
+        # Create indexes
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_session_timestamp
+                         ON messages(session_id, timestamp DESC)''')
+        cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_session_seq
+                         ON messages(session_id, seq)''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_compressed_content
+                         ON compressed_messages(content_hash, settings_key)''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS idx_sessions_activity
+                         ON sessions(last_activity, session_id)''')
+
+    logger.info("✅ Database initialized successfully")
 
 
 def estimate_tokens(text: str) -> int:
-    """Estimate token count (roughly 4 chars per token)"""
-    return len(text) // 4
-
-def store_message_with_usage(session_id: str, role: str, content: str, 
-                             input_tokens: int = 0, output_tokens: int = 0):
-    """Store message with actual token usage from API"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO messages (session_id, role, content, input_tokens, output_tokens)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (session_id, role, content, input_tokens, output_tokens))
-    
-    conn.commit()
-    conn.close()
+    """Count tokens with the chat model's tokenizer (see tokenizer.py)"""
+    return count_tokens(text)
+
+def store_message_with_usage(session_id: str, role: str, content: str,
+                             input_tokens: int = 0, output_tokens: int = 0, cached_tokens: int = 0,
+                             reasoning_tokens: int = 0):
+    """Store message with actual token usage from API.
+
+    cached_tokens is the part of input_tokens served from the prompt cache,
+    reasoning_tokens the part of output_tokens spent on hidden reasoning.
+    """
+    counter = get_counter()
+    token_count = counter.count(content)
+    stored_content = text_codec.encode(content)
+
+    with transaction(immediate=True) as conn:
+        # seq is the message's 1-based position within its session
+        message_id = conn.execute('''
+            INSERT INTO messages (session_id, seq, role, content, input_tokens, output_tokens,
+                                  cached_tokens, reasoning_tokens, token_count, token_counter)
+            SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ?, ?, ?, ?, ?, ?
+            FROM messages WHERE session_id = ?
+        ''', (session_id, role, stored_content, input_tokens, output_tokens,
+              cached_tokens, reasoning_tokens, token_count, counter.name, session_id)).lastrowid
+        seq = conn.execute('SELECT seq FROM messages WHERE id = ?', (message_id,)).fetchone()[0]
+
+        if SEARCH_AVAILABLE:
+            conn.execute('''
+                INSERT INTO messages_fts (rowid, content, session_id) VALUES (?, ?, ?)
+            ''', (message_id, content, session_id))
+
+        message = {"id": message_id, "seq": seq, "role": role, "content": content, "tokens": token_count}
+        after_commit(lambda: session_cache.append_message(session_id, message))
+
+
+def store_turn(session_id: str, prompt: str, response: str,
+               input_tokens: int = 0, output_tokens: int = 0, cached_tokens: int = 0,
+               reasoning_tokens: int = 0, model: Optional[str] = None):
+    """Store a user prompt and the assistant reply (with its usage) in one transaction.
+
+    Either both messages are stored or neither, so a failed LLM call
+    leaves no half-written turn behind. The usage is also charged to model
+    (default: the chat route's first model) in the usage ledger.
+    """
+    with transaction(immediate=True):
+        store_message_with_usage(session_id, "user", prompt)
+        store_message_with_usage(session_id, "assistant", response, input_tokens, output_tokens,
+                                 cached_tokens, reasoning_tokens)
+        record_model_usage(session_id, model or primary_model("chat"), "chat",
+                           input_tokens, output_tokens, cached_tokens, reasoning_tokens)
+
+
+def record_model_usage(session_id: str, model: str, task: str, input_tokens: int = 0,
+                       output_tokens: int = 0, cached_tokens: int = 0, reasoning_tokens: int = 0):
+    """Add one LLM call to a session's usage ledger"""
+    with transaction(immediate=True) as conn:
+        conn.execute('''
+            INSERT INTO model_usage (session_id, model, task, calls, input_tokens, output_tokens,
+                                     cached_tokens, reasoning_tokens)
+            VALUES (?, ?, ?, 1, ?, ?, ?, ?)
+            ON CONFLICT (session_id, model, task) DO UPDATE SET
+                calls = calls + 1,
+                input_tokens = input_tokens + excluded.input_tokens,
+                output_tokens = output_tokens + excluded.output_tokens,
+                cached_tokens = cached_tokens + excluded.cached_tokens,
+                reasoning_tokens = reasoning_tokens + excluded.reasoning_tokens
+        ''', (session_id, model, task, input_tokens, output_tokens, cached_tokens, reasoning_tokens))
+
+
+# Columns read by every message query, in _message_from_row order
+MESSAGE_COLUMNS = "id, seq, role, content, token_count, token_counter"
+
+
+def _message_from_row(row: tuple) -> Dict:
+    """Map a MESSAGE_COLUMNS row to a message dict.
+
+    "tokens" is the cached token count, or None if it was counted with a
+    different tokenizer (or never) and must be recounted.
+    """
+    tokens = row[4] if row[5] == get_counter().name else None
+    return {"id": row[0], "seq": row[1], "role": row[2], "content": text_codec.decode(row[3]), "tokens": tokens}
+
+
+def cache_token_counts(counts: List[tuple], session_id: Optional[str] = None):
+    """Store (message_id, token_count) pairs counted with the current tokenizer.
+
+    With session_id the counts are also written through to the session's
+    cached state, so its messages are not recounted next turn.
+    """
+    counter_name = get_counter().name
+
+    with transaction(immediate=True) as conn:
+        conn.executemany('''
+            UPDATE messages SET token_count = ?, token_counter = ? WHERE id = ?
+        ''', [(count, counter_name, message_id) for message_id, count in counts])
+        if session_id is not None:
+            after_commit(lambda: session_cache.set_token_counts(session_id, dict(counts)))
+
 
 def count_messages(session_id: str) -> int:
-    """Count total messages for a session"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT COUNT(*) FROM messages WHERE session_id = ?
+    """Count total messages for a session (kept in the sessions table)"""
+    cursor = get_connection().execute('''
+        SELECT message_count FROM sessions WHERE session_id = ?
     ''', (session_id,))
-    
-    count = cursor.fetchone()[0]
-    conn.close()
-    
-    return count
-
-
-def get_all_messages(session_id: str) -> List[Dict]:
-    """Get all messages for a session"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT role, content FROM messages 
-        WHERE session_id = ? 
-        ORDER BY timestamp ASC
-    ''', (session_id,))
-    
-    messages = [{"role": row[0], "content": row[1]} for row in cursor.fetchall()]
-    conn.close()
-    
-    return messages
+
+    result = cursor.fetchone()
+
+    return result[0] if result else 0
+
+
+def get_session_state(session_id: str) -> SessionState:
+    """Message count, recent messages and summaries of a session, from memory if hot.
+
+    With SESSION_CACHE_VALIDATE a cached state is first checked against the
+    stored message count (one primary-key read), which catches messages
+    written or deleted by other worker processes.
+    """
+    state = session_cache.get(session_id)
+    if state is not None and SESSION_CACHE_VALIDATE and count_messages(session_id) != state.message_count:
+        session_cache.invalidate(session_id)
+        SESSION_STATE_CACHE.inc(result="stale")
+        state = None
+    elif state is not None:
+        SESSION_STATE_CACHE.inc(result="hit")
+        if state.nodes is not None:
+            return state
+    else:
+        SESSION_STATE_CACHE.inc(result="miss")
+
+    version = session_cache.version
+    if state is not None:
+        # Only the summary tree frontier was dropped (by a new node)
+        state = SessionState(state.message_count, state.messages, state.summaries, get_summary_nodes(session_id))
+    else:
+        with transaction():
+            total_messages = count_messages(session_id)
+            messages = get_last_n_messages(session_id, session_cache.window)
+            latest = get_latest_cached_summary(session_id)
+            nodes = get_summary_nodes(session_id)
+        state = SessionState(total_messages, messages, dict([latest]) if latest else {}, nodes)
+
+    session_cache.put(session_id, state, version)
+    return state
 
 
 def get_last_n_messages(session_id: str, n: int) -> List[Dict]:
     """Get last N messages for a session"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT role, content FROM messages 
-        WHERE session_id = ? 
-        ORDER BY timestamp DESC 
+    cursor = get_connection().execute(f'''
+        SELECT {MESSAGE_COLUMNS} FROM messages
+        WHERE session_id = ?
+        ORDER BY seq DESC
         LIMIT ?
     ''', (session_id, n))
-    
-    messages = [{"role": row[0], "content": row[1]} for row in cursor.fetchall()]
-    conn.close()
-    
+
+    messages = [_message_from_row(row) for row in cursor.fetchall()]
+
     # Reverse to get chronological order
     return list(reversed(messages))
 
 
 def get_messages_range(session_id: str, start: int, end: int) -> List[Dict]:
     """Get messages in a range (1-indexed, inclusive)"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT role, content FROM messages 
-        WHERE session_id = ? 
-        ORDER BY timestamp ASC 
-        LIMIT ? OFFSET ?
-    ''', (session_id, end - start + 1, start - 1))
-    
-    messages = [{"role": row[0], "content": row[1]} for row in cursor.fetchall()]
-    conn.close()
-    
-    return messages
+    cursor = get_connection().execute(f'''
+        SELECT {MESSAGE_COLUMNS} FROM messages
+        WHERE session_id = ? AND seq BETWEEN ? AND ?
+        ORDER BY seq ASC
+    ''', (session_id, start, end))
+
+    return [_message_from_row(row) for row in cursor.fetchall()]
+
+
+def search_messages(session_id: str, match_query: str, max_seq: int, limit: int) -> List[Dict]:
+    """Best full-text matches among a session's messages 1..max_seq, best first.
+
+    Each result is a message dict with an extra "rank" (bm25, lower is better).
+    """
+    if not SEARCH_AVAILABLE:
+        return []
+
+    # Narrow by session inside the index too, so other sessions' hits aren't ranked
+    session_phrase = '"' + session_id.replace('"', '""') + '"'
+    columns = ", ".join(f"m.{column}" for column in MESSAGE_COLUMNS.split(", "))
+
+    cursor = get_connection().execute(f'''
+        SELECT {columns}, bm25(messages_fts, 1.0, 0.0) AS rank
+        FROM messages_fts
+        JOIN messages m ON m.id = messages_fts.rowid
+        WHERE messages_fts MATCH ? AND m.session_id = ? AND m.seq <= ?
+        ORDER BY rank
+        LIMIT ?
+    ''', (f"session_id : {session_phrase} AND ({match_query})", session_id, max_seq, limit))
+
+    return [{**_message_from_row(row), "rank": row[-1]} for row in cursor.fetchall()]
 
 
 def get_cached_summary(session_id: str, messages_covered: int) -> Optional[str]:
     """Get cached summary for specific message count"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT summary_text FROM summaries 
-        WHERE session_id = ? AND messages_covered = ?
+    state = session_cache.get(session_id)
+    if state is not None and messages_covered in state.summaries:
+        return state.summaries[messages_covered]
+
+    cursor = get_connection().execute('''
+        SELECT summary_text FROM summaries
+        WHERE session_id = ? AND level = 0 AND messages_covered = ?
     ''', (session_id, messages_covered))
-    
+
     result = cursor.fetchone()
-    conn.close()
-    
-    return result[0] if result else None
+
+    return text_codec.decode(result[0]) if result else None
 
 
 def get_latest_cached_summary(session_id: str) -> Optional[tuple]:
     """Get the most recent cached summary and its coverage"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT messages_covered, summary_text FROM summaries 
-        WHERE session_id = ? 
-        ORDER BY messages_covered DESC 
+    cursor = get_connection().execute('''
+        SELECT messages_covered, summary_text FROM summaries
+        WHERE session_id = ? AND level = 0
+        ORDER BY messages_covered DESC
         LIMIT 1
     ''', (session_id,))
-    
+
     result = cursor.fetchone()
-    conn.close()
-    
-    return result if result else None
+
+    return (result[0], text_codec.decode(result[1])) if result else None
 
 
 def cache_summary(session_id: str, messages_covered: int, summary: str):
     """Cache a summary"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT OR REPLACE INTO summaries (session_id, messages_covered, summary_text)
-        VALUES (?, ?, ?)
-    ''', (session_id, messages_covered, summary))
-    
-    conn.commit()
-    conn.close()
+    with transaction(immediate=True) as conn:
+        # An upsert rather than INSERT OR REPLACE, whose implicit delete
+        # would not fire the summary-count triggers
+        conn.execute('''
+            INSERT INTO summaries (session_id, level, span_start, messages_covered, summary_text)
+            VALUES (?, 0, 1, ?, ?)
+            ON CONFLICT (session_id, level, messages_covered) DO UPDATE SET
+                summary_text = excluded.summary_text,
+                created_at = CURRENT_TIMESTAMP
+        ''', (session_id, messages_covered, text_codec.encode(summary)))
+        after_commit(lambda: session_cache.add_summary(session_id, messages_covered, summary))
 
 
-def get_session_stats(session_id: str) -> Dict:
-    """Get statistics with accurate costs"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
-    cursor = conn.cursor()
-    
-    # Total messages
-    cursor.execute('SELECT COUNT(*) FROM messages WHERE session_id = ?', (session_id,))
-    total_messages = cursor.fetchone()[0]
-    
-    # Cached summaries
-    cursor.execute('SELECT COUNT(*) FROM summaries WHERE session_id = ?', (session_id,))
-    summary_count = cursor.fetchone()[0]
-    
-    # Actual token usage
-    cursor.execute('''
-        SELECT 
-            SUM(input_tokens) as total_input,
-            SUM(output_tokens) as total_output
-        FROM messages 
-        WHERE session_id = ?
+def prune_summaries(keep_checkpoints: int, checkpoint_every: int, batch_size: int) -> int:
+    """Delete up to batch_size superseded "story so far" summaries.
+
+    Per session, the latest summary is kept, plus the newest keep_checkpoints
+    summaries whose coverage is a multiple of checkpoint_every. Summary tree
+    nodes (level >= 1) are pruned as they are merged, not here.
+    """
+    with transaction(immediate=True) as conn:
+        cursor = conn.execute('''
+            DELETE FROM summaries WHERE rowid IN (
+                SELECT rowid FROM (
+                    SELECT
+                        rowid,
+                        messages_covered % :every = 0 AS is_checkpoint,
+                        ROW_NUMBER() OVER (
+                            PARTITION BY session_id ORDER BY messages_covered DESC
+                        ) AS recency,
+                        ROW_NUMBER() OVER (
+                            PARTITION BY session_id, messages_covered % :every = 0
+                            ORDER BY messages_covered DESC
+                        ) AS rank_in_kind
+                    FROM summaries
+                    WHERE level = 0
+                )
+                WHERE recency > 1 AND NOT (is_checkpoint AND rank_in_kind <= :keep)
+                LIMIT :batch
+            )
+        ''', {"every": max(1, checkpoint_every), "keep": keep_checkpoints, "batch": batch_size})
+        return cursor.rowcount
+
+
+def get_summary_nodes(session_id: str) -> List[Dict]:
+    """Get the summary tree frontier (level >= 1 nodes) in message order"""
+    cursor = get_connection().execute('''
+        SELECT level, span_start, messages_covered, summary_text FROM summaries
+        WHERE session_id = ? AND level >= 1
+        ORDER BY span_start ASC
     ''', (session_id,))
-    
+
+    return [
+        {"level": row[0], "span_start": row[1], "span_end": row[2], "text": text_codec.decode(row[3])}
+        for row in cursor.fetchall()
+    ]
+
+
+def store_summary_node(session_id: str, node: Dict, replaces: List[Dict] = ()):
+    """Store a summary tree node, removing the child nodes it was merged from"""
+    with transaction(immediate=True) as conn:
+        conn.executemany('''
+            DELETE FROM summaries
+            WHERE session_id = ? AND level = ? AND messages_covered = ?
+        ''', [(session_id, child['level'], child['span_end']) for child in replaces])
+
+        conn.execute('''
+            INSERT OR REPLACE INTO summaries (session_id, level, span_start, messages_covered, summary_text)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (session_id, node['level'], node['span_start'], node['span_end'], text_codec.encode(node['text'])))
+        after_commit(lambda: session_cache.set_nodes(session_id, None))
+
+
+def get_compressed_message(message_id: int, content_hash: str, settings_key: str) -> Optional[str]:
+    """Get a cached compressed variant of a message, if still valid"""
+    cursor = get_connection().execute('''
+        SELECT compressed_text FROM compressed_messages
+        WHERE message_id = ? AND settings_key = ? AND content_hash = ?
+    ''', (message_id, settings_key, content_hash))
+
     result = cursor.fetchone()
-    total_input = result[0] or 0
-    total_output = result[1] or 0
-    
-    conn.close()
-    
+
+    return result[0] if result else None
+
+
+def cache_compressed_message(message_id: int, content_hash: str, settings_key: str, compressed: str):
+    """Cache a compressed variant of a message"""
+    with transaction(immediate=True) as conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO compressed_messages
+                (message_id, content_hash, settings_key, compressed_text)
+            VALUES (?, ?, ?, ?)
+        ''', (message_id, content_hash, settings_key, compressed))
+
+
+def find_compressed_content(content_hash: str, settings_key: str) -> Optional[str]:
+    """Get a compression of identical content made for any message"""
+    cursor = get_connection().execute('''
+        SELECT compressed_text FROM compressed_messages
+        WHERE content_hash = ? AND settings_key = ?
+        LIMIT 1
+    ''', (content_hash, settings_key))
+
+    result = cursor.fetchone()
+
+    return result[0] if result else None
+
+
+def acquire_lease(lease_key: str, owner: str, ttl: float) -> bool:
+    """Take (or renew) a lease unless another owner holds an unexpired one"""
+    now = time.time()
+
+    with transaction(immediate=True) as conn:
+        cursor = conn.execute('''
+            INSERT INTO leases (lease_key, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (lease_key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+        ''', (lease_key, owner, now + ttl, now))
+        return cursor.rowcount > 0
+
+
+def release_lease(lease_key: str, owner: str):
+    """Give up a lease, if we still hold it"""
+    with transaction(immediate=True) as conn:
+        conn.execute('DELETE FROM leases WHERE lease_key = ? AND owner = ?', (lease_key, owner))
+
+
+def get_rate_buckets(bucket_keys: List[str]) -> Dict[str, tuple]:
+    """Get (tokens, updated_at) for each stored rate-limit bucket"""
+    placeholders = ",".join("?" for _ in bucket_keys)
+    cursor = get_connection().execute(f'''
+        SELECT bucket_key, tokens, updated_at FROM rate_limits
+        WHERE bucket_key IN ({placeholders})
+    ''', list(bucket_keys))
+
+    return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+
+def save_rate_buckets(buckets: Dict[str, tuple]):
+    """Store (tokens, updated_at) for rate-limit buckets"""
+    with transaction(immediate=True) as conn:
+        conn.executemany('''
+            INSERT OR REPLACE INTO rate_limits (bucket_key, tokens, updated_at)
+            VALUES (?, ?, ?)
+        ''', [(key, tokens, updated_at) for key, (tokens, updated_at) in buckets.items()])
+
+
+def prune_rate_buckets(idle_before: float) -> int:
+    """Delete buckets untouched since idle_before (they have refilled anyway)"""
+    with transaction(immediate=True) as conn:
+        cursor = conn.execute('DELETE FROM rate_limits WHERE updated_at < ?', (idle_before,))
+        return cursor.rowcount
+
+
+def get_session_usage(session_id: str) -> List[Dict]:
+    """A session's LLM usage and cost per model and task, most expensive first"""
+    rows = get_connection().execute('''
+        SELECT model, task, calls, input_tokens, output_tokens, cached_tokens, reasoning_tokens
+        FROM model_usage WHERE session_id = ?
+    ''', (session_id,)).fetchall()
+
+    usage = []
+    for model, task, calls, input_tokens, output_tokens, cached_tokens, reasoning in rows:
+        usage.append({
+            "model": model,
+            "task": task,
+            "calls": calls,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "cached_input_tokens": cached_tokens,
+            "reasoning_output_tokens": reasoning,
+            "cost": usage_cost(model, input_tokens, output_tokens, cached_tokens)
+        })
+    usage.sort(key=lambda row: row["cost"]["total"], reverse=True)
+    return usage
+
+
+def get_session_stats(session_id: str) -> Dict:
+    """Get statistics with accurate costs.
+
+    The token totals count the stored chat turns; "models" is the ledger of
+    everything spent on the session (including summaries and compression)
+    per model and task.
+    """
+    cursor = get_connection().execute('''
+        SELECT message_count, summary_count, input_tokens, output_tokens, cached_tokens, reasoning_tokens
+        FROM sessions WHERE session_id = ?
+    ''', (session_id,))
+
+    total_messages, summary_count, total_input, total_output, total_cached, total_reasoning = \
+        cursor.fetchone() or (0, 0, 0, 0, 0, 0)
+
     return {
         "total_messages": total_messages,
         "cached_summaries": summary_count,
         "input_tokens": total_input,      # ← Separate counts
         "output_tokens": total_output,
-        "total_tokens": total_input + total_output
+        "cached_input_tokens": total_cached,
+        "reasoning_output_tokens": total_reasoning,
+        "total_tokens": total_input + total_output,
+        "models": get_session_usage(session_id)
     }
 
 
 def delete_session(session_id: str) -> int:
     """Delete a session and all its data"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
-    cursor = conn.cursor()
-    
-    cursor.execute('DELETE FROM messages WHERE session_id = ?', (session_id,))
-    messages_deleted = cursor.rowcount
-    
-    cursor.execute('DELETE FROM summaries WHERE session_id = ?', (session_id,))
-    
-    conn.commit()
-    conn.close()
-    
+    with transaction(immediate=True) as conn:
+        cursor = conn.cursor()
+
+        if SEARCH_AVAILABLE:
+            # Contentless FTS deletes need the original indexed values
+            cursor.execute('''
+                INSERT INTO messages_fts (messages_fts, rowid, content, session_id)
+                SELECT 'delete', id, decode_text(content), session_id FROM messages WHERE session_id = ?
+            ''', (session_id,))
+
+        cursor.execute('DELETE FROM messages WHERE session_id = ?', (session_id,))
+        messages_deleted = cursor.rowcount
+
+        cursor.execute('DELETE FROM summaries WHERE session_id = ?', (session_id,))
+        cursor.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+        cursor.execute('DELETE FROM model_usage WHERE session_id = ?', (session_id,))
+        after_commit(lambda: session_cache.invalidate(session_id))
+
     return messages_deleted
 
-def get_all_sessions() -> List[Dict]:
-    """Get all unique sessions with their message counts and last activity"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT 
-            session_id,
-            COUNT(*) as message_count,
-            MAX(timestamp) as last_activity
-        FROM messages
-        GROUP BY session_id
-        ORDER BY last_activity DESC
-    ''')
-    
-    sessions = []
-    for row in cursor.fetchall():
-        sessions.append({
-            "session_id": row[0],
-            "message_count": row[1],
-            "last_activity": row[2]
-        })
-    
-    conn.close()
-    return sessions
\ No newline at end of file
+
+def delete_last_messages(session_id: str, count: int) -> int:
+    """Delete a session's newest count messages, and summaries that covered them"""
+    with transaction(immediate=True) as conn:
+        rows = conn.execute('''
+            SELECT id, content FROM messages WHERE session_id = ?
+            ORDER BY seq DESC LIMIT ?
+        ''', (session_id, count)).fetchall()
+
+        if SEARCH_AVAILABLE:
+            conn.executemany('''
+                INSERT INTO messages_fts (messages_fts, rowid, content, session_id)
+                VALUES ('delete', ?, ?, ?)
+            ''', [(row[0], text_codec.decode(row[1]), session_id) for row in rows])
+
+        conn.executemany('DELETE FROM messages WHERE id = ?', [(row[0],) for row in rows])
+
+        remaining = count_messages(session_id)
+        conn.execute('''
+            DELETE FROM summaries WHERE session_id = ? AND messages_covered > ?
+        ''', (session_id, remaining))
+        after_commit(lambda: session_cache.invalidate(session_id))
+
+    return len(rows)
+
+
+def incremental_vacuum(max_pages: int = 0) -> int:
+    """Return free pages to the OS (all of them if max_pages is 0); returns pages freed"""
+    conn = get_connection()
+    before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    # executescript steps the pragma to completion; execute() frees one page
+    conn.executescript(f'PRAGMA incremental_vacuum({int(max_pages)});')
+    return before - conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+
+def full_vacuum():
+    """Rebuild the database file, switching it to incremental auto-vacuum"""
+    conn = get_connection()
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+
+
+# Text columns stored through text_codec, by table
+ENCODED_COLUMNS = {"messages": "content", "summaries": "summary_text"}
+
+
+def use_latest_dictionary() -> Optional[int]:
+    """Encode with the newest stored compression dictionary; returns its id"""
+    row = get_connection().execute(
+        'SELECT dict_id, zdict FROM compression_dicts ORDER BY dict_id DESC LIMIT 1'
+    ).fetchone()
+
+    if row and row[0] != text_codec.dict_id:
+        text_codec.use_dictionary(row[0], row[1])
+    return text_codec.dict_id
+
+
+def train_compression_dictionary(sample_bytes: int = STORAGE_DICT_SAMPLE_BYTES,
+                                 min_sample: int = 0) -> Optional[int]:
+    """Train a dictionary on recent messages and summaries and switch to it.
+
+    Returns the new dictionary id, or None if there was less than
+    min_sample bytes of text to learn from.
+    """
+    samples = []
+    sampled = 0
+
+    # Mostly messages, plus a share of summaries, which are the other big texts
+    for table, budget in (("messages", sample_bytes * 3 // 4), ("summaries", sample_bytes // 4)):
+        column = ENCODED_COLUMNS[table]
+        cursor = get_connection().execute(f'SELECT {column} FROM {table} ORDER BY rowid DESC')
+        taken = 0
+        for (value,) in cursor:
+            text = text_codec.decode(value)
+            samples.append(text)
+            taken += len(text)
+            if taken >= budget:
+                break
+        cursor.close()
+        sampled += taken
+
+    if sampled < max(1, min_sample):
+        return None
+
+    zdict = train_dictionary(samples)
+    with transaction(immediate=True) as conn:
+        dict_id = conn.execute('INSERT INTO compression_dicts (zdict) VALUES (?)', (zdict,)).lastrowid
+
+    text_codec.use_dictionary(dict_id, zdict)
+    logger.info(f"🗜️  Trained compression dictionary {dict_id} on {sampled} bytes of text")
+    return dict_id
+
+
+def ensure_compression_dictionary() -> Optional[int]:
+    """Pick up the newest dictionary, training the first one once there is enough text"""
+    if not text_codec.enabled:
+        return None
+    return use_latest_dictionary() or train_compression_dictionary(min_sample=STORAGE_DICT_MIN_SAMPLE)
+
+
+def encode_stored_text(table: str, after: int = 0, batch_size: int = 500) -> tuple:
+    """Rewrite up to batch_size rows of table (rowid > after) not yet stored the current way.
+
+    Online migration step: plain TEXT rows get compressed, rows encoded
+    with an older dictionary are re-encoded (or, with compression turned
+    off, everything is decoded back to TEXT). Returns (rows rewritten,
+    rowid to continue after, or None once the table is done).
+    """
+    column = ENCODED_COLUMNS[table]
+
+    with transaction(immediate=True) as conn:
+        if text_codec.enabled:
+            header = text_codec.header
+            rows = conn.execute(f'''
+                SELECT rowid, {column} FROM {table}
+                WHERE rowid > ?
+                  AND CASE typeof({column})
+                      WHEN 'text' THEN length(CAST({column} AS BLOB)) >= ?
+                      ELSE substr({column}, 1, ?) != ?
+                  END
+                ORDER BY rowid
+                LIMIT ?
+            ''', (after, text_codec.min_bytes, len(header), header, batch_size)).fetchall()
+        else:
+            rows = conn.execute(f'''
+                SELECT rowid, {column} FROM {table}
+                WHERE rowid > ? AND typeof({column}) = 'blob'
+                ORDER BY rowid
+                LIMIT ?
+            ''', (after, batch_size)).fetchall()
+
+        conn.executemany(f'UPDATE {table} SET {column} = ? WHERE rowid = ?', [
+            (text_codec.encode(text_codec.decode(value)), rowid) for rowid, value in rows
+        ])
+
+    return len(rows), (rows[-1][0] if len(rows) == batch_size else None)
+
+
+def get_database_stats() -> Dict:
+    """File size, free pages and row counts"""
+    conn = get_connection()
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+
+    return {
+        "file_bytes": page_size * page_count,
+        "free_bytes": page_size * conn.execute('PRAGMA freelist_count').fetchone()[0],
+        "auto_vacuum": {0: "none", 1: "full", 2: "incremental"}[conn.execute('PRAGMA auto_vacuum').fetchone()[0]],
+        "sessions": conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0],
+        "messages": conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0],
+        "summaries": conn.execute('SELECT COUNT(*) FROM summaries WHERE level = 0').fetchone()[0],
+        "summary_nodes": conn.execute('SELECT COUNT(*) FROM summaries WHERE level >= 1').fetchone()[0],
+        "compressed_messages": conn.execute('SELECT COUNT(*) FROM compressed_messages').fetchone()[0],
+        "compression_dictionary": text_codec.dict_id,
+        "encoded_messages": conn.execute(
+            "SELECT COUNT(*) FROM messages WHERE typeof(content) = 'blob'"
+        ).fetchone()[0],
+        "encoded_summaries": conn.execute(
+            "SELECT COUNT(*) FROM summaries WHERE typeof(summary_text) = 'blob'"
+        ).fetchone()[0],
+    }
+
+
+def count_sessions() -> int:
+    """Number of sessions (one row each in the sessions table)"""
+    return get_connection().execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+
+def get_sessions_page(limit: int = 100, after: Optional[tuple] = None) -> List[Dict]:
+    """Sessions by most recent activity, one page at a time.
+
+    after is the (last_activity, session_id) of the previous page's last
+    session (keyset pagination), so every page costs the same however many
+    sessions there are.
+    """
+    if after is None:
+        cursor = get_connection().execute('''
+            SELECT session_id, message_count, last_activity FROM sessions
+            ORDER BY last_activity DESC, session_id DESC
+            LIMIT ?
+        ''', (limit,))
+    else:
+        cursor = get_connection().execute('''
+            SELECT session_id, message_count, last_activity FROM sessions
+            WHERE (last_activity, session_id) < (?, ?)
+            ORDER BY last_activity DESC, session_id DESC
+            LIMIT ?
+        ''', (after[0], after[1], limit))
+
+    return [
+        {"session_id": row[0], "message_count": row[1], "last_activity": row[2]}
+        for row in cursor.fetchall()
+    ]
+
+
+# Bulk transfer (see transfer.py)
+
+EXPORT_MESSAGE_COLUMNS = ("session_id, seq, role, content, input_tokens, output_tokens, "
+                          "cached_tokens, reasoning_tokens, timestamp")
+EXPORT_SUMMARY_COLUMNS = "session_id, level, span_start, messages_covered, summary_text, created_at"
+EXPORT_USAGE_COLUMNS = ("session_id, model, task, calls, input_tokens, output_tokens, "
+                        "cached_tokens, reasoning_tokens")
+
+# Maintained row by row; a deferred bulk import drops these and rebuilds once
+BULK_DEFERRED_TRIGGERS = ("trg_messages_insert_sessions", "trg_summaries_insert_sessions")
+BULK_DEFERRED_INDEXES = ("idx_session_timestamp",)
+
+
+def iter_export_messages(session_id: Optional[str] = None, batch_size: int = 1000) -> Iterator[Dict]:
+    """Every message (of one session, or all) in (session_id, seq) order, read in keyset batches"""
+    after = (session_id or "", 0)
+
+    while True:
+        if session_id is None:
+            rows = get_connection().execute(f'''
+                SELECT {EXPORT_MESSAGE_COLUMNS} FROM messages
+                WHERE (session_id, seq) > (?, ?)
+                ORDER BY session_id, seq
+                LIMIT ?
+            ''', (after[0], after[1], batch_size)).fetchall()
+        else:
+            rows = get_connection().execute(f'''
+                SELECT {EXPORT_MESSAGE_COLUMNS} FROM messages
+                WHERE session_id = ? AND seq > ?
+                ORDER BY seq
+                LIMIT ?
+            ''', (session_id, after[1], batch_size)).fetchall()
+
+        for row in rows:
+            yield {
+                "type": "message", "session_id": row[0], "seq": row[1], "role": row[2],
+                "content": text_codec.decode(row[3]), "input_tokens": row[4], "output_tokens": row[5],
+                "cached_tokens": row[6], "reasoning_tokens": row[7], "timestamp": row[8],
+            }
+
+        if len(rows) < batch_size:
+            return
+        after = (rows[-1][0], rows[-1][1])
+
+
+def iter_export_summaries(session_id: Optional[str] = None, batch_size: int = 1000) -> Iterator[Dict]:
+    """Every summary and summary tree node (of one session, or all), in primary key order"""
+    after = (session_id or "", -1, 0)
+
+    while True:
+        if session_id is None:
+            rows = get_connection().execute(f'''
+                SELECT {EXPORT_SUMMARY_COLUMNS} FROM summaries
+                WHERE (session_id, level, messages_covered) > (?, ?, ?)
+                ORDER BY session_id, level, messages_covered
+                LIMIT ?
+            ''', (*after, batch_size)).fetchall()
+        else:
+            rows = get_connection().execute(f'''
+                SELECT {EXPORT_SUMMARY_COLUMNS} FROM summaries
+                WHERE session_id = ? AND (level, messages_covered) > (?, ?)
+                ORDER BY level, messages_covered
+                LIMIT ?
+            ''', (session_id, after[1], after[2], batch_size)).fetchall()
+
+        for row in rows:
+            yield {
+                "type": "summary", "session_id": row[0], "level": row[1], "span_start": row[2],
+                "messages_covered": row[3], "text": text_codec.decode(row[4]), "created_at": row[5],
+            }
+
+        if len(rows) < batch_size:
+            return
+        after = (rows[-1][0], rows[-1][1], rows[-1][3])
+
+
+def iter_export_usage(session_id: Optional[str] = None, batch_size: int = 1000) -> Iterator[Dict]:
+    """The usage ledger (of one session, or all), in primary key order"""
+    after = (session_id or "", "", "")
+
+    while True:
+        if session_id is None:
+            rows = get_connection().execute(f'''
+                SELECT {EXPORT_USAGE_COLUMNS} FROM model_usage
+                WHERE (session_id, model, task) > (?, ?, ?)
+                ORDER BY session_id, model, task
+                LIMIT ?
+            ''', (*after, batch_size)).fetchall()
+        else:
+            rows = get_connection().execute(f'''
+                SELECT {EXPORT_USAGE_COLUMNS} FROM model_usage
+                WHERE session_id = ? AND (model, task) > (?, ?)
+                ORDER BY model, task
+                LIMIT ?
+            ''', (session_id, after[1], after[2], batch_size)).fetchall()
+
+        for row in rows:
+            yield {
+                "type": "usage", "session_id": row[0], "model": row[1], "task": row[2], "calls": row[3],
+                "input_tokens": row[4], "output_tokens": row[5], "cached_tokens": row[6],
+                "reasoning_tokens": row[7],
+            }
+
+        if len(rows) < batch_size:
+            return
+        after = (rows[-1][0], rows[-1][1], rows[-1][2])
+
+
+def get_last_message_id() -> int:
+    """Highest message id so far (0 if none)"""
+    return get_connection().execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+
+
+def session_exists(session_id: str) -> bool:
+    return get_connection().execute(
+        'SELECT 1 FROM sessions WHERE session_id = ?', (session_id,)
+    ).fetchone() is not None
+
+
+def insert_messages_bulk(messages: List[Dict], index_search: bool = True):
+    """Insert exported message records as they are (seq included) in one transaction.
+
+    Token counts are left to be counted lazily when the messages are read.
+    With index_search False the full-text index is filled later by
+    finish_bulk_import.
+    """
+    with transaction(immediate=True) as conn:
+        first_id = get_last_message_id() + 1
+        conn.executemany('''
+            INSERT INTO messages (session_id, seq, role, content, input_tokens, output_tokens,
+                                  cached_tokens, reasoning_tokens, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+        ''', (
+            (msg['session_id'], msg['seq'], msg['role'], text_codec.encode(msg['content']),
+             msg.get('input_tokens') or 0, msg.get('output_tokens') or 0,
+             msg.get('cached_tokens') or 0, msg.get('reasoning_tokens') or 0, msg.get('timestamp'))
+            for msg in messages
+        ))
+
+        if SEARCH_AVAILABLE and index_search:
+            conn.execute('''
+                INSERT INTO messages_fts (rowid, content, session_id)
+                SELECT id, decode_text(content), session_id FROM messages WHERE id >= ?
+            ''', (first_id,))
+
+        session_ids = {msg['session_id'] for msg in messages}
+
+        def invalidate():
+            for session_id in session_ids:
+                session_cache.invalidate(session_id)
+        after_commit(invalidate)
+
+
+def insert_summaries_bulk(summaries: List[Dict]):
+    """Insert exported summary records in one transaction (existing ones are kept)"""
+    with transaction(immediate=True) as conn:
+        conn.executemany('''
+            INSERT INTO summaries (session_id, level, span_start, messages_covered, summary_text, created_at)
+            VALUES (?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+            ON CONFLICT (session_id, level, messages_covered) DO NOTHING
+        ''', (
+            (row['session_id'], row.get('level', 0), row.get('span_start', 1), row['messages_covered'],
+             text_codec.encode(row['text']), row.get('created_at'))
+            for row in summaries
+        ))
+
+
+def insert_usage_bulk(usage: List[Dict]):
+    """Add exported usage ledger records in one transaction"""
+    with transaction(immediate=True) as conn:
+        conn.executemany('''
+            INSERT INTO model_usage (session_id, model, task, calls, input_tokens, output_tokens,
+                                     cached_tokens, reasoning_tokens)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (session_id, model, task) DO UPDATE SET
+                calls = calls + excluded.calls,
+                input_tokens = input_tokens + excluded.input_tokens,
+                output_tokens = output_tokens + excluded.output_tokens,
+                cached_tokens = cached_tokens + excluded.cached_tokens,
+                reasoning_tokens = reasoning_tokens + excluded.reasoning_tokens
+        ''', (
+            (row['session_id'], row['model'], row['task'], row.get('calls') or 0,
+             row.get('input_tokens') or 0, row.get('output_tokens') or 0,
+             row.get('cached_tokens') or 0, row.get('reasoning_tokens') or 0)
+            for row in usage
+        ))
+
+
+def start_bulk_import():
+    """Drop per-row triggers and secondary indexes until finish_bulk_import.
+
+    Only for imports into a database no app process is writing to: their
+    writes would not update the session aggregates meanwhile.
+    """
+    with transaction(immediate=True) as conn:
+        for trigger in BULK_DEFERRED_TRIGGERS:
+            conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        for index in BULK_DEFERRED_INDEXES:
+            conn.execute(f'DROP INDEX IF EXISTS {index}')
+
+
+def finish_bulk_import(first_id: int):
+    """Restore what start_bulk_import dropped and catch up on messages from first_id on.
+
+    Rebuilds the session aggregates of every session those messages belong
+    to, and adds the messages to the full-text index.
+    """
+    # Recreates the triggers and indexes (all IF NOT EXISTS)
+    init_database()
+
+    with transaction(immediate=True) as conn:
+        conn.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS imported_sessions (session_id TEXT PRIMARY KEY)
+        ''')
+        conn.execute('DELETE FROM imported_sessions')
+        conn.execute('''
+            INSERT OR IGNORE INTO imported_sessions SELECT session_id FROM messages WHERE id >= ?
+        ''', (first_id,))
+
+        conn.execute('''
+            INSERT INTO sessions (session_id, message_count, input_tokens, output_tokens,
+                                  cached_tokens, reasoning_tokens, last_activity)
+            SELECT session_id, COUNT(*), COALESCE(SUM(input_tokens), 0), COALESCE(SUM(output_tokens), 0),
+                   COALESCE(SUM(cached_tokens), 0), COALESCE(SUM(reasoning_tokens), 0), MAX(timestamp)
+            FROM messages
+            WHERE session_id IN (SELECT session_id FROM imported_sessions)
+            GROUP BY session_id
+            ON CONFLICT (session_id) DO UPDATE SET
+                message_count = excluded.message_count,
+                input_tokens = excluded.input_tokens,
+                output_tokens = excluded.output_tokens,
+                cached_tokens = excluded.cached_tokens,
+                reasoning_tokens = excluded.reasoning_tokens,
+                last_activity = excluded.last_activity
+        ''')
+        conn.execute('''
+            UPDATE sessions SET summary_count = (
+                SELECT COUNT(*) FROM summaries
+                WHERE summaries.session_id = sessions.session_id AND summaries.level = 0
+            )
+            WHERE session_id IN (SELECT session_id FROM imported_sessions)
+        ''')
+        _backfill_chat_usage(conn.cursor(), [
+            row[0] for row in conn.execute('SELECT session_id FROM imported_sessions')
+        ])
+
+        if SEARCH_AVAILABLE:
+            conn.execute('''
+                INSERT INTO messages_fts (rowid, content, session_id)
+                SELECT id, decode_text(content), session_id FROM messages WHERE id >= ?
+            ''', (first_id,))
+
+        conn.execute('DROP TABLE imported_sessions')
+
+    session_cache.clear()
@@ -1,98 +1,481 @@
-import requests
+import asyncio
+import email.utils
+import importlib.util
 import json
-from typing import List, Dict, Iterator
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+from typing import List, Dict, Iterator, AsyncIterator, Optional
+
+import httpx
+
 from config import (
     OPENROUTER_KEY, 
     OPENROUTER_URL, 
-    MODEL_CONFIG,
     SUMMARY_PROMPT,
-    COMPRESS_PROMPT
+    COMPRESS_PROMPT,
+    LLM_CONNECT_TIMEOUT,
+    LLM_READ_TIMEOUT,
+    LLM_POOL_SIZE,
+    LLM_HTTP2,
+    LLM_MAX_RETRIES,
+    LLM_BACKOFF_BASE,
+    LLM_BACKOFF_MAX,
+    LLM_CIRCUIT_FAILURES,
+    LLM_CIRCUIT_COOLDOWN
 )
+from metrics import LLM_CALLS
+from models import route
 
 
-def call_llm(messages: List[Dict], max_tokens: int = 4000, temperature: float = 0.8) -> str:
-    """Call OpenRouter API"""
-    payload = {
-        "model": MODEL_CONFIG["name"],
-        "messages": messages,
-        "max_tokens": max_tokens,
-        "temperature": temperature,
-    }
+logger = logging.getLogger(__name__)
+
+
+# Responses worth retrying; everything else is returned to the caller as-is
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling the provider while the circuit is open"""
+
+
+class CircuitBreaker:
+    """Stop calling a failing provider for a cool-down period.
+
+    Opens after `failure_threshold` consecutive failures. Once `cooldown`
+    seconds have passed a single trial call is let through (half-open):
+    success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self.cooldown - time.monotonic()
+            if remaining > 0 or self._trial_in_flight:
+                raise CircuitOpenError(
+                    f"LLM provider circuit open, retry in {max(remaining, 0):.1f}s"
+                )
+            self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+    def record_abandoned(self):
+        """A call ended without an outcome (cancelled, unexpected error).
+
+        Only matters for a half-open trial: it counts as failed, so the
+        next trial is let through after another cool-down instead of never.
+        """
+        with self._lock:
+            if self._trial_in_flight:
+                self._trial_in_flight = False
+                self._failures += 1
+                self._opened_at = time.monotonic()
+
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
+    """Seconds to wait according to a Retry-After header, if any"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Delay before retry number `attempt` (0-based): Retry-After or full-jitter backoff"""
+    if retry_after is not None:
+        return min(retry_after, LLM_BACKOFF_MAX)
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * (2 ** attempt)))
+
+
+def _http2_available() -> bool:
+    return LLM_HTTP2 and importlib.util.find_spec("h2") is not None
+
+
+class LLMClient:
+    """Shared keep-alive HTTP client for the chat completions endpoint.
+
+    Connections are pooled (HTTP/2 when the `h2` package is installed),
+    transient failures are retried with jittered exponential backoff that
+    honours Retry-After, and a circuit breaker per model fails fast while
+    that model is down (so callers can fall back to another one).
+    """
+
+    def __init__(self, url: str = OPENROUTER_URL, api_key: Optional[str] = OPENROUTER_KEY):
+        self.url = url
+        self.api_key = api_key
+        self._breakers: Dict[Optional[str], CircuitBreaker] = {}
+        self._client: Optional[httpx.Client] = None
+        self._async_client: Optional[httpx.AsyncClient] = None
+        self._lock = threading.Lock()
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        if not self.api_key:
+            raise RuntimeError("Set OPENROUTER_API_KEY env var")
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+
+    @property
+    def timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+
+    @property
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(max_connections=LLM_POOL_SIZE, max_keepalive_connections=LLM_POOL_SIZE)
+
+    def _get_client(self) -> httpx.Client:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = httpx.Client(
+                        headers=self.headers,
+                        timeout=self.timeout,
+                        limits=self.limits,
+                        http2=_http2_available()
+                    )
+        return self._client
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        # Only touched from the event loop thread, so no lock is needed
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(
+                headers=self.headers,
+                timeout=self.timeout,
+                limits=self.limits,
+                http2=_http2_available()
+            )
+        return self._async_client
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+    def breaker(self, model: Optional[str]) -> CircuitBreaker:
+        """Circuit breaker of one model"""
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(
+                    model, CircuitBreaker(LLM_CIRCUIT_FAILURES, LLM_CIRCUIT_COOLDOWN)
+                )
+        return breaker
+
+    def _check_response(self, response: httpx.Response, attempt: int, breaker: CircuitBreaker) -> bool:
+        """Record the outcome; True if the response should be retried"""
+        if response.status_code < 400:
+            breaker.record_success()
+            return False
+
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()   # The model is up
+
+        return response.status_code in RETRY_STATUS_CODES and attempt < LLM_MAX_RETRIES
+
+    def _send(self, payload: Dict, stream: bool) -> httpx.Response:
+        """Send with retries; returns a successful (2xx) response"""
+        client = self._get_client()
+        breaker = self.breaker(payload.get("model"))
+        attempt = 0
+
+        while True:
+            breaker.before_call()
+            retry_after = None
+
+            try:
+                request = client.build_request("POST", self.url, json=payload)
+                response = client.send(request, stream=stream)
+            except httpx.TransportError as e:
+                breaker.record_failure()
+                if attempt >= LLM_MAX_RETRIES:
+                    raise
+                logger.warning(f"⚠️  LLM transport error ({e.__class__.__name__}), retrying...")
+            except BaseException:
+                breaker.record_abandoned()
+                raise
+            else:
+                if not self._check_response(response, attempt, breaker):
+                    if response.status_code >= 400:
+                        if stream:
+                            response.read()
+                        response.raise_for_status()
+                    return response
+
+                retry_after = _retry_after(response)
+                response.close()
+                logger.warning(f"⚠️  LLM returned {response.status_code}, retrying...")
+
+            time.sleep(backoff_delay(attempt, retry_after))
+            attempt += 1
+
+    def post(self, payload: Dict) -> Dict:
+        """POST a completion request and return the decoded JSON body"""
+        response = self._send(payload, stream=False)
+        return response.json()
+
+    async def _asend(self, payload: Dict, stream: bool) -> httpx.Response:
+        """Async twin of _send"""
+        client = self._get_async_client()
+        breaker = self.breaker(payload.get("model"))
+        attempt = 0
+
+        while True:
+            breaker.before_call()
+            retry_after = None
+
+            try:
+                request = client.build_request("POST", self.url, json=payload)
+                response = await client.send(request, stream=stream)
+            except httpx.TransportError as e:
+                breaker.record_failure()
+                if attempt >= LLM_MAX_RETRIES:
+                    raise
+                logger.warning(f"⚠️  LLM transport error ({e.__class__.__name__}), retrying...")
+            except BaseException:   # e.g. CancelledError when a stream client disconnects
+                breaker.record_abandoned()
+                raise
+            else:
+                if not self._check_response(response, attempt, breaker):
+                    if response.status_code >= 400:
+                        if stream:
+                            await response.aread()
+                        response.raise_for_status()
+                    return response
+
+                retry_after = _retry_after(response)
+                await response.aclose()
+                logger.warning(f"⚠️  LLM returned {response.status_code}, retrying...")
+
+            await asyncio.sleep(backoff_delay(attempt, retry_after))
+            attempt += 1
+
+    @contextmanager
+    def stream(self, payload: Dict) -> Iterator[httpx.Response]:
+        """POST a streaming completion request; retries happen before the first byte"""
+        response = self._send(payload, stream=True)
+        try:
+            yield response
+        finally:
+            response.close()
+
+    @asynccontextmanager
+    async def astream(self, payload: Dict) -> AsyncIterator[httpx.Response]:
+        """Async twin of stream, for use on the event loop"""
+        response = await self._asend(payload, stream=True)
+        try:
+            yield response
+        finally:
+            await response.aclose()
+
+
+# One pooled client per process
+llm_client = LLMClient()
+
+
+def call_llm(messages: List[Dict], max_tokens: int = 4000, temperature: float = 0.8,
+             task: str = "chat", model: Optional[str] = None) -> tuple:
+    """Call OpenRouter API with the models routed to task (model, if given, first).
+
+    Falls back to the next model whenever one fails. Returns (content, usage);
+    usage["model"] names the model that answered.
+    """
+    models = route(task, model)
+
+    for i, name in enumerate(models):
+        payload = {
+            "model": name,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+        }
+
+        try:
+            response_data = llm_client.post(payload)
+            content = response_data["choices"][0]["message"]["content"]
+            usage = {**response_data.get("usage", {}), "model": name}
+
+            LLM_CALLS.inc(model=name, outcome="ok")
+            return content,usage
+        except Exception as e:
+            if i == len(models) - 1:
+                LLM_CALLS.inc(model=name, outcome="error")
+                logger.error(f"❌ LLM call failed: {e}")
+                raise
+            LLM_CALLS.inc(model=name, outcome="fallback")
+            logger.warning(f"⚠️  {name} failed ({e}), falling back to {models[i + 1]}")
+
+def cached_prompt_tokens(usage: Dict) -> int:
+    """Prompt tokens the provider served from its prefix cache (0 if not reported)"""
+    details = (usage or {}).get("prompt_tokens_details") or {}
+    return details.get("cached_tokens") or 0
+
+
+def reasoning_tokens(usage: Dict) -> int:
+    """Completion tokens spent on hidden reasoning (0 if not reported)"""
+    details = (usage or {}).get("completion_tokens_details") or {}
+    return details.get("reasoning_tokens") or 0
+
+
+_STREAM_DONE = object()
+
+
+def _parse_stream_line(line: str):
+    """Parse one SSE line: the event's JSON data, _STREAM_DONE, or None to skip it"""
+    # OpenRouter sends: "data: {...}"
+    if not line or not line.startswith('data: '):
+        return None
     
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_KEY}",
-        "Content-Type": "application/json"
-    }
+    data_str = line[6:]  # Remove "data: " prefix
+    
+    # Check for end signal
+    if data_str == '[DONE]':
+        return _STREAM_DONE
     
     try:
-        r = requests.post(url=OPENROUTER_URL, json=payload, headers=headers, timeout=120)
-        r.raise_for_status()
-        
-        response_data = r.json()
-        content = response_data["choices"][0]["message"]["content"]
-        usage = response_data.get("usage", {})
-
-        return content,usage
-    except Exception as e:
-        print(f"❌ LLM call failed: {e}")
-        raise
+        return json.loads(data_str)
+    except json.JSONDecodeError:
+        return None
+
+
+def _handle_stream_event(data: Dict, usage: Optional[Dict]) -> Optional[str]:
+    """Text chunk of a stream event; its usage, if any, is copied into usage"""
+    # The final event carries usage for the whole request (with empty choices)
+    if usage is not None and data.get('usage'):
+        usage.update(data['usage'])
+    
+    # Extract the text chunk
+    if 'choices' in data and len(data['choices']) > 0:
+        delta = data['choices'][0].get('delta', {})
+        return delta.get('content') or None
+    
+    return None
+
 
-def call_llm_stream(messages: List[Dict], max_tokens: int = 4000, temperature: float = 0.8) -> Iterator[str]:
-    """Call OpenRouter API with streaming"""
-    payload = {
-        "model": MODEL_CONFIG["name"],
+def _stream_payload(messages: List[Dict], max_tokens: int, temperature: float, model: str) -> Dict:
+    return {
+        "model": model,
         "messages": messages,
         "max_tokens": max_tokens,
         "temperature": temperature,
         "top_p": 0.9,
-        "stream": True  # ← Enable streaming!
-    }
-    
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_KEY}",
-        "Content-Type": "application/json"
+        "stream": True,  # ← Enable streaming!
+        # Ask for a final usage event (OpenAI style, plus OpenRouter's accounting)
+        "stream_options": {"include_usage": True},
+        "usage": {"include": True}
     }
-    
-    try:
-        response = requests.post(
-            url=OPENROUTER_URL, 
-            json=payload, 
-            headers=headers, 
-            stream=True,  # ← Important!
-            timeout=120
-        )
-        response.raise_for_status()
-        
-        # Process streaming response
-        for line in response.iter_lines():
-            if line:
-                line = line.decode('utf-8')
-                
-                # OpenRouter sends: "data: {...}"
-                if line.startswith('data: '):
-                    data_str = line[6:]  # Remove "data: " prefix
-                    
-                    # Check for end signal
-                    if data_str == '[DONE]':
+
+
+def call_llm_stream(messages: List[Dict], max_tokens: int = 4000, temperature: float = 0.8,
+                    usage: Optional[Dict] = None, model: Optional[str] = None) -> Iterator[str]:
+    """Call OpenRouter API with streaming.
+
+    If a usage dict is passed, it is filled with the provider's reported
+    usage once the stream ends (left empty if the provider sent none) and
+    the model that answered. Models are tried as in call_llm, but only
+    until the first chunk arrives; a stream that breaks later is an error.
+    """
+    models = route("chat", model)
+
+    for i, name in enumerate(models):
+        started = False
+        try:
+            with llm_client.stream(_stream_payload(messages, max_tokens, temperature, name)) as response:
+                for line in response.iter_lines():
+                    data = _parse_stream_line(line)
+                    if data is _STREAM_DONE:
                         break
-                    
-                    try:
-                        data = json.loads(data_str)
-                        # Extract the text chunk
-                        if 'choices' in data and len(data['choices']) > 0:
-                            delta = data['choices'][0].get('delta', {})
-                            content = delta.get('content', '')
-                            if content:
-                                yield content  # ← Yield each chunk
-                    except json.JSONDecodeError:
-                        continue
-                        
-    except Exception as e:
-        print(f"❌ Streaming LLM call failed: {e}")
-        raise
+                    chunk = _handle_stream_event(data, usage) if data else None
+                    if chunk:
+                        started = True
+                        yield chunk  # ← Yield each chunk
+            LLM_CALLS.inc(model=name, outcome="ok")
+            if usage is not None:
+                usage["model"] = name
+            return
+
+        except Exception as e:
+            if started or i == len(models) - 1:
+                LLM_CALLS.inc(model=name, outcome="error")
+                logger.error(f"❌ Streaming LLM call failed: {e}")
+                raise
+            LLM_CALLS.inc(model=name, outcome="fallback")
+            logger.warning(f"⚠️  {name} failed ({e}), falling back to {models[i + 1]}")
+
+
+async def acall_llm_stream(messages: List[Dict], max_tokens: int = 4000, temperature: float = 0.8,
+                           usage: Optional[Dict] = None, model: Optional[str] = None) -> AsyncIterator[str]:
+    """Call OpenRouter API with streaming, without blocking the event loop (as call_llm_stream)"""
+    models = route("chat", model)
+
+    for i, name in enumerate(models):
+        started = False
+        try:
+            async with llm_client.astream(_stream_payload(messages, max_tokens, temperature, name)) as response:
+                async for line in response.aiter_lines():
+                    data = _parse_stream_line(line)
+                    if data is _STREAM_DONE:
+                        break
+                    chunk = _handle_stream_event(data, usage) if data else None
+                    if chunk:
+                        started = True
+                        yield chunk
+            LLM_CALLS.inc(model=name, outcome="ok")
+            if usage is not None:
+                usage["model"] = name
+            return
+
+        except Exception as e:
+            if started or i == len(models) - 1:
+                LLM_CALLS.inc(model=name, outcome="error")
+                logger.error(f"❌ Streaming LLM call failed: {e}")
+                raise
+            LLM_CALLS.inc(model=name, outcome="fallback")
+            logger.warning(f"⚠️  {name} failed ({e}), falling back to {models[i + 1]}")
 
-def generate_summary(messages: List[Dict], max_tokens: int = 2000) -> str:
-    """Generate summary using LLM"""
+def generate_summary(messages: List[Dict], max_tokens: int = 2000, usage: Optional[Dict] = None) -> str:
+    """Generate summary using the summary route (usage, if passed, is filled as in call_llm)"""
     # Format messages for summary
     conversation_text = ""
     for msg in messages:
@@ -104,24 +487,32 @@ def generate_summary(messages: List[Dict], max_tokens: int = 2000) -> str:
     ]
     
     try:
-        summary,_ = call_llm(summary_messages, max_tokens=max_tokens, temperature=0.5)
+        summary,call_usage = call_llm(summary_messages, max_tokens=max_tokens, temperature=0.5, task="summary")
+        if usage is not None:
+            usage.update(call_usage)
         return summary
     except Exception as e:
-        print(f"❌ Summary generation failed: {e}")
+        logger.error(f"❌ Summary generation failed: {e}")
         return "Story context available."
 
 
-def compress_message(content: str, target_tokens: int = 800) -> str:
-    """Compress a single long message"""
+def compress_message(content: str, target_tokens: int = 800, fallback: bool = True,
+                     usage: Optional[Dict] = None) -> str:
+    """Compress a single long message with the compress route (set fallback=False to
+    raise instead of truncating; usage as in generate_summary)"""
     compress_messages = [
         {"role": "system", "content": COMPRESS_PROMPT},
         {"role": "user", "content": content}
     ]
     
     try:
-        compressed,_ = call_llm(compress_messages, max_tokens=target_tokens, temperature=0.8)
+        compressed,call_usage = call_llm(compress_messages, max_tokens=target_tokens, temperature=0.8, task="compress")
+        if usage is not None:
+            usage.update(call_usage)
         return compressed
     except Exception as e:
-        print(f"❌ Message compression failed: {e}")
+        logger.error(f"❌ Message compression failed: {e}")
+        if not fallback:
+            raise
         # Fallback: truncate
         return content[:target_tokens * 4]
\ No newline at end of file
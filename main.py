@@ -1,25 +1,64 @@
-import time
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
+from typing import Optional
+import base64
 import json
+import logging
+import time
 import uvicorn
-from config import MODEL_CONFIG, MIN_REQUEST_INTERVAL
-from database import init_database, store_message_with_usage, get_session_stats, delete_session, count_messages, get_cached_summary,estimate_tokens,get_all_sessions
-from context import build_context, generate_summary_incremental
-from llm_utils import call_llm
+from config import MODELS, MODEL_CONFIG, LOG_LEVEL, TURN_GROUP_COMMIT
+from database import init_database, get_session_stats, delete_session, count_messages,estimate_tokens,get_sessions_page,count_sessions,close_all_connections
+from context import build_context, check_prompt_size, PromptTooLargeError, ensure_summary, summary_coverage, summary_scheduler, schedule_summary_refresh
+from tokenizer import count_context_tokens
+from llm_utils import call_llm, acall_llm_stream, llm_client, cached_prompt_tokens, reasoning_tokens
+from rate_limiter import rate_limiter, RateLimitExceeded
+from maintenance import maintenance_worker
+from turn_writer import turn_writer, save_turn
+from metrics import render_metrics, start_trace, finish_trace, record_stage, timed, CHAT_TOKENS
 import os
 
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
 app = FastAPI()
 
-# Rate limiting
-last_request_time = 0
 #uvicorn port
 port = 9000
 # Initialize database on startup
 init_database()
 
 
+@app.on_event("startup")
+def startup():
+    """Start background summarization, maintenance and group commit"""
+    summary_scheduler.start()
+    maintenance_worker.start()
+    if TURN_GROUP_COMMIT:
+        turn_writer.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Stop background work and close pooled connections"""
+    summary_scheduler.stop()
+    maintenance_worker.stop()
+    turn_writer.stop()
+    llm_client.close()
+    await llm_client.aclose()
+    close_all_connections()
+
+
+def rate_limited(e: RateLimitExceeded) -> HTTPException:
+    """429 response for a rejected request"""
+    return HTTPException(
+        status_code=429, 
+        detail=str(e),
+        headers={"Retry-After": str(max(1, round(e.retry_after)))}
+    )
+
+
 @app.get("/")
 def root():
     return FileResponse("index.html")
@@ -27,65 +66,77 @@ def root():
 
 class PromptIn(BaseModel):
     prompt: str
-    model: str = MODEL_CONFIG["name"]
+    model: Optional[str] = None     # Tried before the chat route's models
     session_id: str = "default"
     max_tokens: int = MODEL_CONFIG["max_output"]
 
 
+def check_request(body: PromptIn):
+    """Only models with known pricing may be requested, and the prompt must fit the input limit"""
+    if body.model is not None and body.model not in MODELS:
+        raise HTTPException(status_code=400, detail=f"Unknown model {body.model}; available: {', '.join(MODELS)}")
+    try:
+        check_prompt_size(body.prompt)
+    except PromptTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+
 @app.post("/api/chat")
 def chat(body: PromptIn):
-    global last_request_time
-    
+    check_request(body)
+
     # Rate limiting
-    current_time = time.time()
-    time_since_last = current_time - last_request_time
-    
-    if time_since_last < MIN_REQUEST_INTERVAL:
-        wait_time = MIN_REQUEST_INTERVAL - time_since_last
-        raise HTTPException(
-            status_code=429, 
-            detail=f"Please wait {wait_time:.1f} seconds"
-        )
-    
-    print(f"\n{'='*60}")
-    print(f"📨 New request from session: {body.session_id}")
-    print(f"💬 User prompt: {body.prompt[:100]}...")
+    try:
+        rate_limiter.acquire(body.session_id)
+    except RateLimitExceeded as e:
+        raise rate_limited(e)
     
-    # Store user message
-    store_message_with_usage(body.session_id, "user", body.prompt, input_tokens=0, output_tokens=0)
+    trace = start_trace(endpoint="chat", session_id=body.session_id)
+    logger.info(f"📨 New request from session: {body.session_id}")
+    logger.debug(f"💬 User prompt: {body.prompt[:100]}...")
     
-    # Build context
-    context = build_context(body.session_id, body.prompt)
+    # Build context from the stored history; the prompt is stored with the reply
+    with timed("context_build"):
+        context = build_context(body.session_id, body.prompt)
     
     # Add current prompt
     context.append({"role": "user", "content": body.prompt})
     
     try:
-        print(f"🚀 Sending request to {body.model}...")
+        logger.debug(f"🚀 Sending request to {body.model or 'the chat route'}...")
         
         # Call LLM
-        assistant_response,usage = call_llm(context, max_tokens=body.max_tokens)
-        
-        last_request_time = time.time()
+        with timed("llm"):
+            assistant_response,usage = call_llm(context, max_tokens=body.max_tokens, model=body.model)
 
         # Extract actual token counts
         prompt_tokens = usage.get("prompt_tokens", 0)
         completion_tokens = usage.get("completion_tokens", 0)
         total_tokens = usage.get("total_tokens", 0)
+        cached_tokens = cached_prompt_tokens(usage)
+        
+        logger.info(f"📊 Tokens - Input: {prompt_tokens} ({cached_tokens} cached), Output: {completion_tokens}, Total: {total_tokens}")
+        CHAT_TOKENS.inc(prompt_tokens, direction="in")
+        CHAT_TOKENS.inc(completion_tokens, direction="out")
         
-        print(f"📊 Tokens - Input: {prompt_tokens}, Output: {completion_tokens}, Total: {total_tokens}")
+        # Store the prompt and AI response together, with ACTUAL token counts
+        with timed("db_write"):
+            save_turn(
+                body.session_id, 
+                body.prompt, 
+                assistant_response,
+                input_tokens=prompt_tokens,      # ← Real numbers!
+                output_tokens=completion_tokens,
+                cached_tokens=cached_tokens,
+                reasoning_tokens=reasoning_tokens(usage),
+                model=usage.get("model")
+            )
         
-        # Store AI response with ACTUAL token count
-        store_message_with_usage(
-            body.session_id, 
-            "assistant", 
-            assistant_response,
-            input_tokens=prompt_tokens,      # ← Real numbers!
-            output_tokens=completion_tokens
-        )
+        # Precompute the next turn's summary off the request path
+        schedule_summary_refresh(body.session_id)
         
-        print(f"✅ Response generated: {len(assistant_response)} chars")
-        print(f"{'='*60}\n")
+        logger.debug(f"✅ Response generated: {len(assistant_response)} chars")
+        finish_trace(trace, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
         
         return {
             "choices": [
@@ -100,7 +151,8 @@ def chat(body: PromptIn):
         }
         
     except Exception as e:
-        print(f"❌ Error: {e}")
+        logger.error(f"❌ Error: {e}")
+        finish_trace(trace, error=str(e))
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -112,22 +164,16 @@ def get_summary_endpoint(session_id: str):
     if total_messages == 0:
         return {"session_id": session_id, "summary": "No messages yet", "messages": 0}
     
-    from config import RECENT_MESSAGE_COUNT
+    old_count = summary_coverage(total_messages)
     
-    if total_messages <= RECENT_MESSAGE_COUNT:
+    if old_count == 0:
         return {
             "session_id": session_id, 
             "summary": "Conversation too short for summary",
             "messages": total_messages
         }
     
-    old_count = total_messages - RECENT_MESSAGE_COUNT
-    summary = get_cached_summary(session_id, old_count)
-    
-    if not summary:
-        from database import cache_summary
-        summary = generate_summary_incremental(session_id, old_count)
-        cache_summary(session_id, old_count, summary)
+    summary = ensure_summary(session_id, old_count)
     
     return {
         "session_id": session_id,
@@ -142,18 +188,25 @@ def get_stats(session_id: str):
     """Get statistics for a session"""
     stats = get_session_stats(session_id)
 
-    # Calculate REAL costs
-    input_cost = (stats['input_tokens'] / 1_000_000) * MODEL_CONFIG['input_cost_per_1m']
-    output_cost = (stats['output_tokens'] / 1_000_000) * MODEL_CONFIG['output_cost_per_1m']
+    # Calculate REAL costs at each model's prices (prompt-cache hits are
+    # billed at the discounted rate), summaries and compression included
+    cached_input = stats['cached_input_tokens']
+    input_cost = sum(row['cost']['input'] for row in stats['models'])
+    output_cost = sum(row['cost']['output'] for row in stats['models'])
     total_cost = input_cost + output_cost
+    by_task = {}
+    for row in stats['models']:
+        by_task[row['task']] = by_task.get(row['task'], 0.0) + row['cost']['total']
     
     return {
         "session_id": session_id,
         **stats,
+        "cache_hit_rate": round(cached_input / stats['input_tokens'], 4) if stats['input_tokens'] else 0.0,
         "costs": {
             "input": f"${input_cost:.6f}",
             "output": f"${output_cost:.6f}",
-            "total": f"${total_cost:.6f}"
+            "total": f"${total_cost:.6f}",
+            "by_task": {task: f"${cost:.6f}" for task, cost in by_task.items()}
         }
     }
 
@@ -169,89 +222,121 @@ def delete_session_endpoint(session_id: str):
 @app.post("/api/chat/stream")
 async def chat_stream(body: PromptIn):
     """Streaming chat endpoint"""
-    global last_request_time
-    
+    check_request(body)
+
     # Rate limiting
-    current_time = time.time()
-    time_since_last = current_time - last_request_time
-    
-    if time_since_last < MIN_REQUEST_INTERVAL:
-        wait_time = MIN_REQUEST_INTERVAL - time_since_last
-        raise HTTPException(
-            status_code=429, 
-            detail=f"Please wait {wait_time:.1f} seconds"
-        )
-    
-    print(f"\n{'='*60}")
-    print(f"📨 Streaming request from session: {body.session_id}")
-    print(f"💬 User prompt: {body.prompt[:100]}...")
+    try:
+        await rate_limiter.acquire_async(body.session_id)
+    except RateLimitExceeded as e:
+        raise rate_limited(e)
     
-    # Store user message
-    store_message_with_usage(body.session_id, "user", body.prompt, input_tokens=0, output_tokens=0)
+    trace = start_trace(endpoint="chat_stream", session_id=body.session_id)
+    logger.info(f"📨 Streaming request from session: {body.session_id}")
+    logger.debug(f"💬 User prompt: {body.prompt[:100]}...")
     
-    # Build context
-    context = build_context(body.session_id, body.prompt)
+    # Build context from the stored history (blocking DB and LLM work runs
+    # off the event loop); the prompt is stored with the reply
+    with timed("context_build"):
+        context = await run_in_threadpool(build_context, body.session_id, body.prompt)
     context.append({"role": "user", "content": body.prompt})
     
     # Generator function for streaming
     async def generate():
-        from llm_utils import call_llm_stream
-        
         full_response = ""
-        total_input_tokens = 0
-        total_output_tokens = 0
         
         try:
-            print(f"🚀 Starting stream to {body.model}...")
-            last_request_time = time.time()
+            logger.debug(f"🚀 Starting stream to {body.model or 'the chat route'}...")
+            llm_start = time.perf_counter()
             
-            # Stream chunks
-            for chunk in call_llm_stream(context, max_tokens=body.max_tokens):
+            # Stream chunks; the provider reports usage in its final event
+            usage = {}
+            async for chunk in acall_llm_stream(context, max_tokens=body.max_tokens, usage=usage, model=body.model):
+                if not full_response:
+                    record_stage("ttft", time.perf_counter() - llm_start, trace)
                 full_response += chunk
                 yield f"data: {json.dumps({'content': chunk})}\n\n"
+            record_stage("llm", time.perf_counter() - llm_start, trace)
             
-            # After streaming completes, call once more to get usage stats
-            # (OpenRouter doesn't provide usage in streaming mode, so we estimate)
-
-            # Estimate input tokens from context
-            total_input_tokens = sum(estimate_tokens(msg['content']) for msg in context)
-
-            # Estimate output tokens from response
-            total_output_tokens = estimate_tokens(full_response)
+            estimated = not usage.get("prompt_tokens")
+            if estimated:
+                # No usage from the provider: count locally instead
+                logger.warning("⚠️  Stream sent no usage, estimating token counts")
+                usage = {
+                    "model": usage.get("model"),
+                    "prompt_tokens": count_context_tokens(context),
+                    "completion_tokens": estimate_tokens(full_response)
+                }
+            
+            total_input_tokens = usage.get("prompt_tokens", 0)
+            total_output_tokens = usage.get("completion_tokens", 0)
+            cached_tokens = cached_prompt_tokens(usage)
             
             # Signal completion with token info
             yield "data: " + json.dumps({
                     'done': True,
-                    'usage': {
-                        'prompt_tokens': total_input_tokens,
-                        'completion_tokens': total_output_tokens
-                    }
+                    'usage': {**usage, 'estimated': estimated}
             }) + "\n\n"
             
-            # Store with token usage
-            store_message_with_usage(
+            CHAT_TOKENS.inc(total_input_tokens, direction="in")
+            CHAT_TOKENS.inc(total_output_tokens, direction="out")
+            
+            # Store the prompt and response together, with token usage
+            db_start = time.perf_counter()
+            await run_in_threadpool(
+                save_turn,
                 body.session_id, 
-                "assistant", 
+                body.prompt, 
                 full_response,
                 input_tokens=total_input_tokens,
-                output_tokens=total_output_tokens
+                output_tokens=total_output_tokens,
+                cached_tokens=cached_tokens,
+                reasoning_tokens=reasoning_tokens(usage),
+                model=usage.get("model")
             )
+            record_stage("db_write", time.perf_counter() - db_start, trace)
+            await run_in_threadpool(schedule_summary_refresh, body.session_id)
             
-            print(f"✅ Stream complete: {len(full_response)} chars")
-            print(f"📊 Tokens - Input: {total_input_tokens}, Output: {total_output_tokens}")
+            logger.debug(f"✅ Stream complete: {len(full_response)} chars")
+            logger.info(f"📊 Tokens - Input: {total_input_tokens} ({cached_tokens} cached), Output: {total_output_tokens}"
+                        f"{' (estimated)' if estimated else ''}")
+            finish_trace(trace, prompt_tokens=total_input_tokens, completion_tokens=total_output_tokens)
             
         except Exception as e:
-            print(f"❌ Streaming error: {e}")
+            logger.error(f"❌ Streaming error: {e}")
+            finish_trace(trace, error=str(e))
             yield f"data: {json.dumps({'error': str(e)})}\n\n"
     
     return StreamingResponse(generate(), media_type="text/event-stream")
 
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus metrics"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+def encode_cursor(session: dict) -> str:
+    """Opaque pagination cursor pointing just after session"""
+    raw = json.dumps([session['last_activity'], session['session_id']])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        last_activity, session_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return last_activity, session_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
 @app.get("/api/sessions")
-def get_sessions():
-    """Get all saved story sessions"""
-    sessions = get_all_sessions()
-    return {"sessions": sessions, "total": len(sessions)}
+def get_sessions(limit: int = Query(100, ge=1, le=1000), cursor: Optional[str] = None):
+    """Get saved story sessions, most recent first, a page at a time"""
+    after = decode_cursor(cursor) if cursor else None
+    sessions = get_sessions_page(limit, after)
+    next_cursor = encode_cursor(sessions[-1]) if len(sessions) == limit else None
+    return {"sessions": sessions, "total": count_sessions(), "next_cursor": next_cursor}
 
 if __name__ == "__main__":
-    print(f"🚀 Starting server on port {port}")
+    logger.info(f"🚀 Starting server on port {port}")
     uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
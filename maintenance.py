@@ -0,0 +1,190 @@
+"""Database maintenance: summary retention, space reclamation and admin tasks.
+
+Runs in the background inside the app (MaintenanceWorker) and as a CLI:
+
+  python maintenance.py stats
+  python maintenance.py prune [--keep N] [--every N]
+  python maintenance.py vacuum [--full]
+  python maintenance.py compress [--retrain]
+  python maintenance.py delete-session SESSION_ID
+  python maintenance.py delete-last SESSION_ID [--count N]
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from config import (
+    SUMMARY_KEEP_CHECKPOINTS,
+    SUMMARY_CHECKPOINT_EVERY,
+    MAINTENANCE_INTERVAL,
+    MAINTENANCE_BATCH_SIZE,
+    VACUUM_PAGES_PER_RUN
+)
+from database import (
+    init_database,
+    prune_summaries,
+    incremental_vacuum,
+    full_vacuum,
+    get_database_stats,
+    delete_session,
+    delete_last_messages,
+    acquire_lease,
+    release_lease,
+    ENCODED_COLUMNS,
+    encode_stored_text,
+    ensure_compression_dictionary,
+    train_compression_dictionary,
+    text_codec
+)
+
+
+logger = logging.getLogger(__name__)
+
+# Pause between batches so request writers can get the write lock
+BATCH_PAUSE = 0.05
+
+
+def prune_all_summaries(keep_checkpoints: int = SUMMARY_KEEP_CHECKPOINTS,
+                        checkpoint_every: int = SUMMARY_CHECKPOINT_EVERY,
+                        batch_size: int = MAINTENANCE_BATCH_SIZE) -> int:
+    """Prune superseded summaries in short batches; returns rows deleted"""
+    total = 0
+
+    while True:
+        deleted = prune_summaries(keep_checkpoints, checkpoint_every, batch_size)
+        total += deleted
+        if deleted < batch_size:
+            return total
+        time.sleep(BATCH_PAUSE)
+
+
+# Storage encoding whose migration last finished in this process; new rows
+# are written that way, so the tables need no further scans until it changes
+_encoded_header = None
+
+
+def encode_all_text(batch_size: int = MAINTENANCE_BATCH_SIZE) -> int:
+    """Migrate stored text to the current encoding in short batches; returns rows rewritten"""
+    global _encoded_header
+    header = (text_codec.enabled, text_codec.header)
+    if header == _encoded_header:
+        return 0
+
+    total = 0
+    for table in ENCODED_COLUMNS:
+        after = 0
+        while after is not None:
+            rewritten, after = encode_stored_text(table, after, batch_size)
+            total += rewritten
+            if after is not None:
+                time.sleep(BATCH_PAUSE)
+
+    _encoded_header = header
+    return total
+
+
+def run_maintenance() -> dict:
+    """One maintenance pass; skipped if another worker process is running one"""
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    if not acquire_lease("maintenance", owner, max(60.0, MAINTENANCE_INTERVAL)):
+        return {}
+
+    try:
+        pruned = prune_all_summaries()
+        ensure_compression_dictionary()
+        encoded = encode_all_text()
+        freed = incremental_vacuum(VACUUM_PAGES_PER_RUN)
+    finally:
+        release_lease("maintenance", owner)
+
+    if pruned or encoded or freed:
+        logger.info(f"🧹 Maintenance: pruned {pruned} summaries, encoded {encoded} rows, freed {freed} pages")
+    return {"pruned_summaries": pruned, "encoded_rows": encoded, "freed_pages": freed}
+
+
+class MaintenanceWorker:
+    """Runs run_maintenance every interval seconds on a daemon thread"""
+
+    def __init__(self, interval: float = MAINTENANCE_INTERVAL):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None or self.interval <= 0:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                run_maintenance()
+            except Exception as e:
+                logger.error(f"❌ Maintenance failed: {e}")
+
+
+maintenance_worker = MaintenanceWorker()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Story database maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("stats", help="show database size and row counts")
+
+    prune = commands.add_parser("prune", help="delete superseded summaries")
+    prune.add_argument("--keep", type=int, default=SUMMARY_KEEP_CHECKPOINTS, help="checkpoints kept per session")
+    prune.add_argument("--every", type=int, default=SUMMARY_CHECKPOINT_EVERY, help="checkpoint coverage interval")
+
+    vacuum = commands.add_parser("vacuum", help="return free pages to the OS")
+    vacuum.add_argument("--full", action="store_true",
+                        help="rebuild the file (needed once to enable incremental vacuum on old databases)")
+
+    compress = commands.add_parser("compress", help="compress stored text with the current dictionary")
+    compress.add_argument("--retrain", action="store_true", help="train a new dictionary on recent text first")
+
+    delete = commands.add_parser("delete-session", help="delete a session and all its data")
+    delete.add_argument("session_id")
+
+    delete_last = commands.add_parser("delete-last", help="delete a session's newest messages")
+    delete_last.add_argument("session_id")
+    delete_last.add_argument("--count", type=int, default=2, help="messages to delete (default: last exchange)")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    init_database()
+
+    if args.command == "stats":
+        print(json.dumps(get_database_stats(), indent=2))
+    elif args.command == "prune":
+        print(f"Pruned {prune_all_summaries(args.keep, args.every)} summaries")
+    elif args.command == "vacuum":
+        if args.full:
+            full_vacuum()
+            print("Database rebuilt")
+        else:
+            print(f"Freed {incremental_vacuum()} pages")
+    elif args.command == "compress":
+        dict_id = train_compression_dictionary() if args.retrain else ensure_compression_dictionary()
+        print(f"Dictionary: {dict_id}")
+        print(f"Encoded {encode_all_text()} rows")
+    elif args.command == "delete-session":
+        print(f"Deleted {delete_session(args.session_id)} messages")
+    elif args.command == "delete-last":
+        print(f"Deleted {delete_last_messages(args.session_id, args.count)} messages")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import contextvars
+import json
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+# Seconds; covers a fast cache read up to a slow LLM call
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_registry: List["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Monotonic count, optionally split by labels"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        if not values and not self.labelnames:
+            values = [((), 0)]
+        return super().render() + [
+            f"{self.name}{_label_text(self.labelnames, key)} {value:g}" for key, value in values
+        ]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], list] = {}   # key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            series = sorted((key, list(values)) for key, values in self._series.items())
+
+        lines = super().render()
+        for key, values in series:
+            for bound, count in zip(self.buckets, values):
+                le = f'le="{bound:g}"'
+                lines.append(f"{self.name}_bucket{_label_text(self.labelnames, key, le)} {count}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_label_text(self.labelnames, key, le)} {values[-1]}")
+            lines.append(f"{self.name}_sum{_label_text(self.labelnames, key)} {values[-2]:g}")
+            lines.append(f"{self.name}_count{_label_text(self.labelnames, key)} {values[-1]}")
+        return lines
+
+
+def render_metrics() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Metrics recorded by the app
+STAGE_SECONDS = Histogram(
+    "story_stage_seconds", "Time spent per stage of a chat turn", ("stage",)
+)
+LLM_CALLS = Counter(
+    "story_llm_calls_total", "LLM requests by model and outcome (ok, fallback, error)", ("model", "outcome")
+)
+SUMMARY_CACHE = Counter(
+    "story_summary_cache_total", "Summary lookups by result (hit, stale, miss)", ("result",)
+)
+COMPRESSION_CACHE = Counter(
+    "story_compression_cache_total", "Compression lookups by result (hit, shared, miss)", ("result",)
+)
+SESSION_STATE_CACHE = Counter(
+    "story_session_cache_total", "In-process session state lookups by result (hit, miss, stale)", ("result",)
+)
+# No session label: one series per session would grow without bound.
+# Per-session token counts are in the database (/api/stats/{session})
+CHAT_TOKENS = Counter(
+    "story_chat_tokens_total", "Chat LLM tokens by direction (in, out)", ("direction",)
+)
+RATE_LIMIT_REJECTIONS = Counter(
+    "story_rate_limit_rejections_total", "Requests refused by the rate limiter"
+)
+
+
+# Per-request traces: stage durations for one chat turn, logged as one JSON line
+_current_trace: contextvars.ContextVar[Optional[Dict]] = contextvars.ContextVar("trace", default=None)
+trace_logger = logging.getLogger("trace")
+
+
+def start_trace(**fields) -> Dict:
+    """Begin a trace for this request; stages timed in this context are added to it"""
+    trace = {"request_id": uuid.uuid4().hex[:12], **fields, "stages": {}, "_start": time.perf_counter()}
+    _current_trace.set(trace)
+    return trace
+
+
+def finish_trace(trace: Dict, **fields):
+    """Record the total time and log the trace"""
+    total = time.perf_counter() - trace.pop("_start")
+    trace.update(fields)
+    trace["stages"]["total"] = round(total, 4)
+    STAGE_SECONDS.observe(total, stage="total")
+    if trace_logger.isEnabledFor(logging.INFO):
+        trace_logger.info(json.dumps(trace))
+
+
+def record_stage(stage: str, seconds: float, trace: Optional[Dict] = None):
+    """Add a stage duration to the histogram and to the trace (default: current)"""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    trace = trace if trace is not None else _current_trace.get()
+    if trace is not None:
+        trace["stages"][stage] = round(trace["stages"].get(stage, 0) + seconds, 4)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Time a block as one stage of the current request"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
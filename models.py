@@ -0,0 +1,42 @@
+"""Model registry lookups: which models serve a task, and what their tokens cost.
+
+Routes and prices live in config.py (MODELS, MODEL_ROUTES).
+"""
+from typing import Dict, List, Optional
+
+from config import MODELS, MODEL_ROUTES, MODEL_CONFIG
+
+
+TASKS = ("chat", "summary", "compress")
+
+for _task, _models in MODEL_ROUTES.items():
+    _unknown = [name for name in _models if name not in MODELS]
+    if not _models or _unknown:
+        raise ValueError(f"MODEL_ROUTES[{_task!r}] must list models from MODELS (unknown: {_unknown})")
+
+
+def route(task: str, requested: Optional[str] = None) -> List[str]:
+    """Models to try for a task, in order; a requested model goes first"""
+    models = list(MODEL_ROUTES.get(task) or MODEL_ROUTES["chat"])
+    if requested:
+        models = [requested] + [name for name in models if name != requested]
+    return models
+
+
+def primary_model(task: str) -> str:
+    return route(task)[0]
+
+
+def model_info(name: Optional[str]) -> Dict:
+    """Registry entry of a model; unknown models are priced like the default chat model"""
+    return MODELS.get(name) or MODEL_CONFIG
+
+
+def usage_cost(model: Optional[str], input_tokens: int, output_tokens: int, cached_tokens: int = 0) -> Dict:
+    """Cost in USD of the given usage; cached prompt tokens are billed at the discounted rate"""
+    info = model_info(model)
+    cached_rate = info.get('cached_input_cost_per_1m', info['input_cost_per_1m'])
+    input_cost = ((input_tokens - cached_tokens) / 1_000_000) * info['input_cost_per_1m'] \
+        + (cached_tokens / 1_000_000) * cached_rate
+    output_cost = (output_tokens / 1_000_000) * info['output_cost_per_1m']
+    return {"input": input_cost, "output": output_cost, "total": input_cost + output_cost}
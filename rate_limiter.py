@@ -0,0 +1,120 @@
+import asyncio
+import time
+from typing import List, Tuple
+
+from config import (
+    MIN_REQUEST_INTERVAL,
+    RATE_LIMIT_SESSION_BURST,
+    RATE_LIMIT_GLOBAL_RATE,
+    RATE_LIMIT_GLOBAL_BURST,
+    RATE_LIMIT_POLICY,
+    RATE_LIMIT_MAX_WAIT
+)
+from database import transaction, get_rate_buckets, save_rate_buckets, prune_rate_buckets
+from metrics import RATE_LIMIT_REJECTIONS
+
+
+# Idle buckets are pruned every this many acquisitions
+PRUNE_EVERY = 1000
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a request may not proceed; retry_after is in seconds"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Please wait {retry_after:.1f} seconds")
+        self.retry_after = retry_after
+
+
+class TokenBucketLimiter:
+    """Per-session and global token buckets stored in SQLite.
+
+    Every request takes one token from its session's bucket and one from
+    the global bucket, atomically. Buckets refill continuously at `rate`
+    tokens per second up to `burst`. Because the state lives in the
+    database, all uvicorn workers share the same limits.
+    """
+
+    def __init__(self, session_rate: float, session_burst: float,
+                 global_rate: float, global_burst: float,
+                 policy: str = "queue", max_wait: float = 5.0):
+        self.session_rate = session_rate
+        self.session_burst = session_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.policy = policy
+        self.max_wait = max_wait
+        self._acquisitions = 0
+
+    def _buckets(self, session_id: str) -> List[Tuple[str, float, float]]:
+        return [
+            (f"session:{session_id}", self.session_rate, self.session_burst),
+            ("global", self.global_rate, self.global_burst),
+        ]
+
+    def try_acquire(self, session_id: str) -> float:
+        """Take a token if possible; returns 0, or the seconds until one is available"""
+        buckets = self._buckets(session_id)
+        now = time.time()
+
+        with transaction(immediate=True):
+            stored = get_rate_buckets([key for key, _, _ in buckets])
+            refilled = {}
+            wait = 0.0
+
+            for key, rate, burst in buckets:
+                tokens, updated_at = stored.get(key, (burst, now))
+                tokens = min(burst, tokens + max(0.0, now - updated_at) * rate)
+                refilled[key] = tokens
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+
+            if wait > 0:
+                return wait
+
+            save_rate_buckets({key: (tokens - 1, now) for key, tokens in refilled.items()})
+
+        self._acquisitions += 1
+        if self._acquisitions % PRUNE_EVERY == 0:
+            # A bucket idle for burst/rate seconds is full again, same as absent
+            idle = max(self.session_burst / self.session_rate, self.global_burst / self.global_rate)
+            prune_rate_buckets(now - idle)
+
+        return 0.0
+
+    def _check_wait(self, wait: float, deadline: float):
+        if self.policy == "reject" or time.monotonic() + wait > deadline:
+            RATE_LIMIT_REJECTIONS.inc()
+            raise RateLimitExceeded(wait)
+
+    def acquire(self, session_id: str):
+        """Take a token, queueing up to max_wait seconds; raises RateLimitExceeded"""
+        deadline = time.monotonic() + self.max_wait
+
+        while True:
+            wait = self.try_acquire(session_id)
+            if wait == 0:
+                return
+            self._check_wait(wait, deadline)
+            time.sleep(wait)
+
+    async def acquire_async(self, session_id: str):
+        """Like acquire, but waits without blocking the event loop"""
+        deadline = time.monotonic() + self.max_wait
+
+        while True:
+            wait = await asyncio.to_thread(self.try_acquire, session_id)
+            if wait == 0:
+                return
+            self._check_wait(wait, deadline)
+            await asyncio.sleep(wait)
+
+
+rate_limiter = TokenBucketLimiter(
+    session_rate=1 / MIN_REQUEST_INTERVAL,
+    session_burst=RATE_LIMIT_SESSION_BURST,
+    global_rate=RATE_LIMIT_GLOBAL_RATE,
+    global_burst=RATE_LIMIT_GLOBAL_BURST,
+    policy=RATE_LIMIT_POLICY,
+    max_wait=RATE_LIMIT_MAX_WAIT
+)
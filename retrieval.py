@@ -0,0 +1,69 @@
+import re
+from typing import Dict, List, Optional
+
+from config import RETRIEVAL_TOP_K, RETRIEVAL_TOKEN_BUDGET, RETRIEVAL_MAX_TERMS, MESSAGE_TOKEN_OVERHEAD
+from database import search_messages, estimate_tokens
+
+
+# Words too common to say anything about which scene is relevant
+STOPWORDS = {
+    "the", "and", "for", "are", "but", "not", "you", "all", "any", "can", "had", "her",
+    "was", "one", "our", "out", "has", "him", "his", "how", "its", "who", "did", "get",
+    "she", "too", "use", "that", "with", "have", "this", "will", "your", "from", "they",
+    "them", "then", "than", "been", "were", "what", "when", "where", "which", "while",
+    "would", "there", "their", "about", "into", "just", "like", "some", "could", "should",
+    "continue", "story", "write", "next", "scene", "please",
+}
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def build_match_query(text: str) -> Optional[str]:
+    """FTS5 query matching any distinctive word of text, or None if there are none"""
+    terms = []
+
+    for word in _WORD.findall(text.lower()):
+        if len(word) < 3 or word in STOPWORDS or word.isdigit() or word in terms:
+            continue
+        terms.append(word)
+        if len(terms) >= RETRIEVAL_MAX_TERMS:
+            break
+
+    if not terms:
+        return None
+
+    # Quote every term so FTS5 operators in user text are taken literally
+    return " OR ".join(f'"{term}"' for term in terms)
+
+
+def retrieve_passages(session_id: str, prompt: str, archived_upto: int,
+                      token_budget: int = RETRIEVAL_TOKEN_BUDGET) -> List[Dict]:
+    """Most relevant archived messages (seq <= archived_upto) that fit the budget.
+
+    Returned in story order, each with cached 'tokens'.
+    """
+    if archived_upto <= 0 or token_budget <= 0:
+        return []
+
+    match_query = build_match_query(prompt)
+    if match_query is None:
+        return []
+
+    chosen = []
+    used = 0
+
+    for message in search_messages(session_id, match_query, archived_upto, RETRIEVAL_TOP_K * 3):
+        tokens = message['tokens'] if message['tokens'] is not None else estimate_tokens(message['content'])
+        if used + tokens + MESSAGE_TOKEN_OVERHEAD > token_budget:
+            continue
+        chosen.append(message)
+        used += tokens + MESSAGE_TOKEN_OVERHEAD
+        if len(chosen) >= RETRIEVAL_TOP_K:
+            break
+
+    return sorted(chosen, key=lambda message: message['seq'])
+
+
+def format_passages(passages: List[Dict]) -> str:
+    """Render retrieved messages as one block for the context"""
+    return "\n\n".join(f"[Message {msg['seq']}, {msg['role']}]: {msg['content']}" for msg in passages)
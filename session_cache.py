@@ -0,0 +1,174 @@
+"""In-process LRU of hot session state, kept current by write-through.
+
+database.py updates an entry after each write it commits, so building the
+context for an active session needs no queries beyond an optional one-row
+freshness check (see get_session_state).
+"""
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+
+# Rough bytes per cached object on top of its text, for memory accounting
+MESSAGE_OVERHEAD = 200
+ENTRY_OVERHEAD = 500
+
+
+class SessionState:
+    """Immutable snapshot of a session: message count, level-0 summaries
+    by coverage, the newest messages in seq order, and the summary tree
+    frontier (None until loaded). Updates replace the whole snapshot, so
+    readers never see a half-applied write.
+    """
+
+    __slots__ = ("message_count", "messages", "summaries", "nodes", "size")
+
+    def __init__(self, message_count: int, messages: List[Dict],
+                 summaries: Optional[Dict[int, str]] = None, nodes: Optional[List[Dict]] = None):
+        self.message_count = message_count
+        self.messages = tuple(messages)
+        self.summaries = dict(summaries or {})
+        self.nodes = tuple(nodes) if nodes is not None else None
+
+        self.size = ENTRY_OVERHEAD + sum(len(msg['content']) + MESSAGE_OVERHEAD for msg in self.messages)
+        self.size += sum(len(text) + MESSAGE_OVERHEAD for text in self.summaries.values())
+        self.size += sum(len(node['text']) + MESSAGE_OVERHEAD for node in self.nodes or ())
+
+    def messages_from(self, start: int) -> Optional[List[Dict]]:
+        """Copies of messages start..message_count, or None if some are not held"""
+        first = self.messages[0]['seq'] if self.messages else self.message_count + 1
+        if start < first:
+            return None
+        return [dict(msg) for msg in self.messages if msg['seq'] >= start]
+
+    def latest_summary(self) -> Optional[tuple]:
+        """(coverage, text) of the newest summary held, like get_latest_cached_summary"""
+        if not self.summaries:
+            return None
+        coverage = max(self.summaries)
+        return coverage, self.summaries[coverage]
+
+    def summary_nodes(self) -> Optional[List[Dict]]:
+        """Copies of the summary tree frontier, or None if not loaded"""
+        return None if self.nodes is None else [dict(node) for node in self.nodes]
+
+
+class SessionCache:
+    """Session states in least-recently-used order, bounded by approximate bytes.
+
+    window is how many of the newest messages each entry keeps. A state
+    loaded from the database is only stored if no write reached the cache
+    while it was being read (see version), so a slow load cannot overwrite
+    a newer write-through.
+    """
+
+    def __init__(self, max_bytes: int, window: int):
+        self.max_bytes = max_bytes
+        self.window = window
+        self.bytes = 0
+        self._entries: "OrderedDict[str, SessionState]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @property
+    def version(self) -> int:
+        """Changes on every write-through or invalidation"""
+        with self._lock:
+            return self._version
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, session_id: str) -> Optional[SessionState]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            state = self._entries.get(session_id)
+            if state is not None:
+                self._entries.move_to_end(session_id)
+        return state
+
+    def put(self, session_id: str, state: SessionState, version: int):
+        """Store a state read from the database, unless a write happened since version"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if version == self._version:
+                self._set(session_id, state)
+
+    def invalidate(self, session_id: str):
+        with self._lock:
+            self._version += 1
+            self._drop(session_id)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+            self.bytes = 0
+
+    def append_message(self, session_id: str, message: Dict):
+        """Write-through of a newly stored message"""
+        with self._lock:
+            self._version += 1
+            state = self._entries.get(session_id)
+            if state is None:
+                return
+            if message['seq'] != state.message_count + 1:
+                # Someone else wrote in between; reload on next read
+                self._drop(session_id)
+                return
+            messages = state.messages[-(self.window - 1):] if self.window > 1 else ()
+            self._set(session_id, SessionState(
+                message['seq'], list(messages) + [dict(message)], state.summaries, state.nodes
+            ))
+
+    def add_summary(self, session_id: str, messages_covered: int, summary: str):
+        """Write-through of a "story so far" summary; old coverages are let go"""
+        with self._lock:
+            self._version += 1
+            state = self._entries.get(session_id)
+            if state is None:
+                return
+            summaries = {**state.summaries, messages_covered: summary}
+            newest = max(summaries)
+            summaries = {coverage: text for coverage, text in summaries.items()
+                         if coverage > newest - self.window}
+            self._set(session_id, SessionState(state.message_count, state.messages, summaries, state.nodes))
+
+    def set_nodes(self, session_id: str, nodes: Optional[List[Dict]]):
+        """Replace the cached summary tree frontier (None drops it until reloaded)"""
+        with self._lock:
+            self._version += 1
+            state = self._entries.get(session_id)
+            if state is None:
+                return
+            self._set(session_id, SessionState(state.message_count, state.messages, state.summaries, nodes))
+
+    def set_token_counts(self, session_id: str, counts: Dict[int, int]):
+        """Write-through of token counts (message id -> count) stored for cached messages"""
+        with self._lock:
+            self._version += 1
+            state = self._entries.get(session_id)
+            if state is None:
+                return
+            messages = [{**msg, "tokens": counts[msg['id']]} if msg['id'] in counts else msg
+                        for msg in state.messages]
+            self._set(session_id, SessionState(state.message_count, messages, state.summaries, state.nodes))
+
+    def _set(self, session_id: str, state: SessionState):
+        self._drop(session_id)
+        self._entries[session_id] = state
+        self.bytes += state.size
+        while self.bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= evicted.size
+
+    def _drop(self, session_id: str):
+        state = self._entries.pop(session_id, None)
+        if state is not None:
+            self.bytes -= state.size
@@ -0,0 +1,87 @@
+import logging
+import queue
+import threading
+from typing import Callable, Dict, List, Optional, Set
+
+
+logger = logging.getLogger(__name__)
+
+
+class SummaryScheduler:
+    """Queue + worker pool that generates summaries off the request path.
+
+    Jobs are keyed by session: scheduling a session that is already queued
+    only raises its target coverage, and a session is never summarized by
+    two workers at once.
+    """
+
+    def __init__(self, job: Callable[[str, int], object], workers: int = 2):
+        self._job = job
+        self._workers = max(1, workers)
+        self._queue: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._pending: Dict[str, int] = {}      # session_id -> target coverage
+        self._running: Set[str] = set()
+        self._lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+
+    @property
+    def running(self) -> bool:
+        return bool(self._threads)
+
+    def start(self):
+        """Start the worker threads"""
+        if self._threads:
+            return
+
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._run, name=f"summary-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        logger.info(f"🧵 Summary workers started ({self._workers})")
+
+    def stop(self, timeout: float = 5.0):
+        """Stop the worker threads, abandoning queued jobs"""
+        threads, self._threads = self._threads, []
+
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join(timeout)
+
+        with self._lock:
+            self._pending.clear()
+
+    def schedule(self, session_id: str, target_coverage: int):
+        """Ask for a summary of session_id covering target_coverage messages"""
+        with self._lock:
+            if session_id in self._pending:
+                self._pending[session_id] = max(self._pending[session_id], target_coverage)
+                return
+
+            self._pending[session_id] = target_coverage
+            if session_id not in self._running:
+                self._queue.put(session_id)
+
+    def _run(self):
+        while True:
+            session_id = self._queue.get()
+            if session_id is None:
+                return
+
+            with self._lock:
+                target_coverage = self._pending.pop(session_id, None)
+                if target_coverage is None:
+                    continue
+                self._running.add(session_id)
+
+            try:
+                self._job(session_id, target_coverage)
+            except Exception as e:
+                logger.error(f"❌ Background summary failed for {session_id}: {e}")
+            finally:
+                with self._lock:
+                    self._running.discard(session_id)
+                    # Re-queue if a newer target arrived while we were busy
+                    if session_id in self._pending:
+                        self._queue.put(session_id)
@@ -0,0 +1,114 @@
+"""At-rest encoding of message and summary text.
+
+Texts shorter than min_bytes are stored as plain TEXT. Longer ones become
+a BLOB: one codec byte, then (for CODEC_ZLIB_DICT) the 4-byte id of the
+preset dictionary, then a zlib stream. Plain TEXT written by older
+versions still decodes, so databases can be migrated row by row.
+"""
+import threading
+import zlib
+from collections import Counter
+from typing import Callable, Dict, Iterable, Optional, Union
+
+
+CODEC_ZLIB = 1          # zlib, no dictionary
+CODEC_ZLIB_DICT = 2     # zlib with a preset dictionary, id follows the marker
+
+# zlib only looks back this far, so a larger dictionary is wasted
+MAX_DICT_SIZE = 32 * 1024
+
+
+def dictionary_header(dict_id: int) -> bytes:
+    """Leading bytes of every value encoded with this dictionary"""
+    return bytes([CODEC_ZLIB_DICT]) + dict_id.to_bytes(4, "big")
+
+
+class TextCodec:
+    """Encodes with the current dictionary, decodes with any stored one.
+
+    load_dictionary(dict_id) fetches a dictionary this process has not seen
+    yet, e.g. one trained by another worker process.
+    """
+
+    def __init__(self, level: int = 6, min_bytes: int = 200, enabled: bool = True,
+                 load_dictionary: Optional[Callable[[int], Optional[bytes]]] = None):
+        self.level = level
+        self.min_bytes = min_bytes
+        self.enabled = enabled
+        self.load_dictionary = load_dictionary
+        self.dict_id: Optional[int] = None
+        self._dictionaries: Dict[int, bytes] = {}
+        self._lock = threading.Lock()
+
+    def use_dictionary(self, dict_id: int, zdict: bytes):
+        """Encode new values with this dictionary from now on"""
+        with self._lock:
+            self._dictionaries[dict_id] = zdict
+            self.dict_id = dict_id
+
+    @property
+    def header(self) -> bytes:
+        """Marker of values encoded the current way (for finding rows to migrate)"""
+        return dictionary_header(self.dict_id) if self.dict_id is not None else bytes([CODEC_ZLIB])
+
+    def encode(self, text: str) -> Union[str, bytes]:
+        data = text.encode("utf-8")
+        if not self.enabled or len(data) < self.min_bytes:
+            return text
+
+        dict_id = self.dict_id
+        if dict_id is None:
+            return bytes([CODEC_ZLIB]) + zlib.compress(data, self.level)
+
+        compressor = zlib.compressobj(self.level, zdict=self._dictionaries[dict_id])
+        return dictionary_header(dict_id) + compressor.compress(data) + compressor.flush()
+
+    def decode(self, value: Union[str, bytes, None]) -> Optional[str]:
+        if value is None or isinstance(value, str):
+            return value
+
+        codec = value[0]
+        if codec == CODEC_ZLIB:
+            return zlib.decompress(value[1:]).decode("utf-8")
+        if codec == CODEC_ZLIB_DICT:
+            decompressor = zlib.decompressobj(zdict=self._dictionary(int.from_bytes(value[1:5], "big")))
+            return (decompressor.decompress(value[5:]) + decompressor.flush()).decode("utf-8")
+        raise ValueError(f"Unknown text codec {codec}")
+
+    def _dictionary(self, dict_id: int) -> bytes:
+        zdict = self._dictionaries.get(dict_id)
+        if zdict is None:
+            zdict = self.load_dictionary(dict_id) if self.load_dictionary else None
+            if zdict is None:
+                raise ValueError(f"Compression dictionary {dict_id} not found")
+            with self._lock:
+                self._dictionaries[dict_id] = zdict
+        return zdict
+
+
+def train_dictionary(samples: Iterable[str], size: int = MAX_DICT_SIZE) -> bytes:
+    """Build a zlib preset dictionary from sample texts.
+
+    zlib has no trainer, so this keeps the word sequences (up to 4 words)
+    that would save the most bytes, frequency times length, and puts the
+    most valuable last where matches are cheapest to encode.
+    """
+    size = min(size, MAX_DICT_SIZE)
+    counts = Counter()
+    for text in samples:
+        words = text.split()
+        for n in (1, 2, 3, 4):
+            counts.update(" ".join(words[i:i + n]) for i in range(len(words) - n + 1))
+
+    ranked = sorted(((count - 1) * len(phrase), phrase) for phrase, count in counts.items() if count > 2)
+
+    chosen = []
+    used = 0
+    for _, phrase in reversed(ranked):
+        length = len(phrase.encode("utf-8")) + 1
+        if used + length > size:
+            continue
+        chosen.append(phrase)
+        used += length
+
+    return " ".join(reversed(chosen)).encode("utf-8")
@@ -0,0 +1,84 @@
+import functools
+import logging
+from typing import Dict, List, Optional
+
+from config import MODELS, MODEL_CONFIG, MESSAGE_TOKEN_OVERHEAD
+
+try:
+    import tiktoken
+except ImportError:     # Optional: fall back to the character heuristic
+    tiktoken = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class HeuristicCounter:
+    """Roughly 4 characters per token; used when no tokenizer is available"""
+
+    name = "heuristic"
+
+    def count(self, text: str) -> int:
+        return len(text) // 4
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        return [self.count(text) for text in texts]
+
+
+class TiktokenCounter:
+    """Exact counts from a local BPE encoding"""
+
+    def __init__(self, encoding_name: str):
+        self.encoding = tiktoken.get_encoding(encoding_name)
+        self.name = f"tiktoken:{encoding_name}"
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode_ordinary(text))
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        return [len(tokens) for tokens in self.encoding.encode_ordinary_batch(texts)]
+
+
+@functools.lru_cache(maxsize=None)
+def _counter_for(encoding_name: Optional[str]):
+    if encoding_name and tiktoken is not None:
+        try:
+            return TiktokenCounter(encoding_name)
+        except Exception as e:  # Unknown encoding, or its file can't be fetched
+            logger.warning(f"⚠️  Tokenizer {encoding_name} unavailable ({e}), using heuristic counts")
+    return HeuristicCounter()
+
+
+def get_counter(model: Optional[str] = None):
+    """Token counter for a model (defaults to the chat model)"""
+    if model is None:
+        return _counter_for(MODEL_CONFIG.get("tokenizer"))
+    return _counter_for(MODELS.get(model, {}).get("tokenizer"))
+
+
+@functools.lru_cache(maxsize=4096)
+def _count_cached(counter_name: str, text: str) -> int:
+    return get_counter().count(text)
+
+
+def count_tokens(text: str) -> int:
+    """Count tokens in text for the chat model (memoized)"""
+    return _count_cached(get_counter().name, text)
+
+
+def count_tokens_batch(texts: List[str]) -> List[int]:
+    """Count tokens for many texts in one call"""
+    return get_counter().count_batch(texts)
+
+
+def count_context_tokens(messages: List[Dict]) -> int:
+    """Tokens for a whole context, reusing per-message counts where known"""
+    missing = [msg['content'] for msg in messages if msg.get('tokens') is None]
+    counted = iter(count_tokens_batch(missing)) if missing else iter(())
+
+    total = 0
+    for msg in messages:
+        tokens = msg.get('tokens')
+        total += (tokens if tokens is not None else next(counted)) + MESSAGE_TOKEN_OVERHEAD
+
+    return total
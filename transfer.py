@@ -0,0 +1,230 @@
+"""Streaming export and import of sessions as JSONL.
+
+One JSON record per line, messages first, then summaries, then the
+per-model usage ledger:
+
+  {"type": "message", "session_id": ..., "seq": 1, "role": "user", "content": ...,
+   "input_tokens": 0, "output_tokens": 0, "cached_tokens": 0, "reasoning_tokens": 0,
+   "timestamp": ...}
+  {"type": "summary", "session_id": ..., "level": 0, "span_start": 1,
+   "messages_covered": 40, "text": ..., "created_at": ...}
+  {"type": "usage", "session_id": ..., "model": ..., "task": "summary", "calls": 3,
+   "input_tokens": 0, "output_tokens": 0, "cached_tokens": 0, "reasoning_tokens": 0}
+
+Files ending in .gz are compressed; "-" is stdin/stdout. Both directions
+stream in batches, so memory use does not grow with the number of rows.
+Sessions from older files, which have no usage records, get their chat
+usage charged to the default chat model.
+
+  python transfer.py export [-o FILE] [--session ID ...]
+  python transfer.py import FILE [--replace] [--live] [--rebuild-summaries] [--workers N]
+"""
+import argparse
+import gzip
+import io
+import json
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from config import IMPORT_BATCH_SIZE, IMPORT_SUMMARY_WORKERS
+from database import (
+    init_database,
+    iter_export_messages,
+    iter_export_summaries,
+    iter_export_usage,
+    insert_messages_bulk,
+    insert_summaries_bulk,
+    insert_usage_bulk,
+    start_bulk_import,
+    finish_bulk_import,
+    get_last_message_id,
+    session_exists,
+    backfill_chat_usage,
+    count_messages,
+    delete_session
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+def _open(path: str, mode: str):
+    if path == "-":
+        stream = sys.stdin.buffer if "r" in mode else sys.stdout.buffer
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def export_records(session_ids: Optional[List[str]] = None) -> Iterator[Dict]:
+    """Records for the given sessions (default: all): messages, summaries, then usage"""
+    for session_id in session_ids or [None]:
+        yield from iter_export_messages(session_id)
+    for session_id in session_ids or [None]:
+        yield from iter_export_summaries(session_id)
+    for session_id in session_ids or [None]:
+        yield from iter_export_usage(session_id)
+
+
+def export_sessions(path: str, session_ids: Optional[List[str]] = None) -> int:
+    """Write sessions to a JSONL file; returns records written"""
+    written = 0
+    with _open(path, "w") as f:
+        for record in export_records(session_ids):
+            f.write(json.dumps(record, ensure_ascii=False))
+            f.write("\n")
+            written += 1
+    return written
+
+
+def read_records(path: str) -> Iterator[Dict]:
+    """Records from a JSONL file, one line at a time"""
+    with _open(path, "r") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Line {line_number}: {e}") from None
+
+
+def import_records(records: Iterable[Dict], replace: bool = False, deferred: bool = True,
+                   batch_size: int = IMPORT_BATCH_SIZE) -> Dict:
+    """Insert records in batches of batch_size rows, one transaction each.
+
+    Sessions already in the database are skipped, or with replace deleted
+    first. Messages without a seq are numbered in file order. deferred
+    drops per-row triggers and secondary indexes for the duration and
+    rebuilds them once at the end: much faster, but only safe while no
+    app process is writing to the database.
+    """
+    sessions: Dict[str, int] = {}           # imported session -> last seq
+    skipped = set()
+    messages: List[Dict] = []
+    summaries: List[Dict] = []
+    usage: List[Dict] = []
+    counts = {"messages": 0, "summaries": 0, "usage": 0}
+
+    def accept(session_id: str) -> bool:
+        if session_id in sessions:
+            return True
+        if session_id in skipped:
+            return False
+        if session_exists(session_id):
+            if not replace:
+                skipped.add(session_id)
+                return False
+            delete_session(session_id)
+        sessions[session_id] = 0
+        return True
+
+    def flush():
+        if messages:
+            insert_messages_bulk(messages, index_search=not deferred)
+            counts["messages"] += len(messages)
+            messages.clear()
+        if summaries:
+            insert_summaries_bulk(summaries)
+            counts["summaries"] += len(summaries)
+            summaries.clear()
+        if usage:
+            insert_usage_bulk(usage)
+            counts["usage"] += len(usage)
+            usage.clear()
+
+    first_id = get_last_message_id() + 1
+    if deferred:
+        start_bulk_import()
+
+    try:
+        for record in records:
+            kind = record.get("type", "message")
+            if kind not in ("message", "summary", "usage"):
+                raise ValueError(f"Unknown record type {kind!r}")
+            if not accept(record["session_id"]):
+                continue
+
+            if kind == "message":
+                seq = record.get("seq") or sessions[record["session_id"]] + 1
+                sessions[record["session_id"]] = seq
+                messages.append({**record, "seq": seq})
+            elif kind == "summary":
+                summaries.append(record)
+            else:
+                usage.append(record)
+
+            if len(messages) + len(summaries) + len(usage) >= batch_size:
+                flush()
+                logger.info(f"📥 Imported {counts['messages']} messages, {counts['summaries']} summaries")
+        flush()
+    finally:
+        if deferred:
+            finish_bulk_import(first_id)
+        else:
+            backfill_chat_usage(list(sessions))
+
+    counts["sessions"] = len(sessions)
+    counts["skipped_sessions"] = len(skipped)
+    counts["session_ids"] = list(sessions)
+    return counts
+
+
+def rebuild_summaries(session_ids: Iterable[str], workers: int = IMPORT_SUMMARY_WORKERS) -> int:
+    """Make sure each session has the summary its next turn needs, several sessions at once.
+
+    Summaries imported from the file are reused; only missing ones cost
+    LLM calls. Returns the number of sessions that needed a summary.
+    """
+    from context import ensure_summary, summary_coverage
+
+    def rebuild(session_id: str) -> bool:
+        coverage = summary_coverage(count_messages(session_id))
+        if coverage > 0:
+            ensure_summary(session_id, coverage)
+        return coverage > 0
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="rebuild") as pool:
+        return sum(pool.map(rebuild, session_ids))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export and import sessions as JSONL")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="write sessions to JSONL")
+    export.add_argument("-o", "--output", default="-", help="file to write (.gz to compress, default stdout)")
+    export.add_argument("--session", action="append", dest="sessions", help="session to export (repeatable)")
+
+    load = commands.add_parser("import", help="load sessions from JSONL")
+    load.add_argument("input", help="file to read (.gz for compressed, - for stdin)")
+    load.add_argument("--replace", action="store_true", help="replace sessions that already exist")
+    load.add_argument("--live", action="store_true",
+                      help="keep triggers and indexes in place (safe while the app is running, slower)")
+    load.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE, help="rows per transaction")
+    load.add_argument("--rebuild-summaries", action="store_true",
+                      help="generate missing summaries for imported sessions (uses the LLM)")
+    load.add_argument("--workers", type=int, default=IMPORT_SUMMARY_WORKERS, help="parallel summary rebuilds")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stderr)
+    init_database()
+
+    if args.command == "export":
+        written = export_sessions(args.output, args.sessions)
+        print(f"Exported {written} records", file=sys.stderr)
+    elif args.command == "import":
+        counts = import_records(read_records(args.input), replace=args.replace,
+                                deferred=not args.live, batch_size=args.batch_size)
+        print(f"Imported {counts['messages']} messages, {counts['summaries']} summaries "
+              f"and {counts['usage']} usage records "
+              f"into {counts['sessions']} sessions ({counts['skipped_sessions']} existing sessions skipped)")
+        if args.rebuild_summaries:
+            print(f"Rebuilt summaries for {rebuild_summaries(counts['session_ids'], args.workers)} sessions")
+
+
+if __name__ == "__main__":
+    main()
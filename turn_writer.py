@@ -0,0 +1,121 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+from config import TURN_GROUP_MAX_DELAY, TURN_GROUP_MAX_SIZE
+from database import transaction, store_turn
+
+
+logger = logging.getLogger(__name__)
+
+
+class TurnWriter:
+    """Write-behind queue that stores chat turns in group commits.
+
+    Turns submitted by concurrent requests are collected for up to
+    max_delay seconds (or max_size turns) and written in one transaction,
+    each inside its own savepoint so a bad turn fails alone. submit()
+    returns a Future that resolves once the turn is committed.
+    """
+
+    def __init__(self, max_delay: float = 0.005, max_size: int = 64):
+        self.max_delay = max_delay
+        self.max_size = max(1, max_size)
+        self._queue: "queue.Queue[Optional[Tuple[Dict, Future]]]" = queue.Queue()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="turn-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Write whatever is queued, then stop"""
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout)
+
+        # Anything queued after the stop marker will not be written
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item[1].set_exception(RuntimeError("Turn writer stopped"))
+
+    def submit(self, **turn) -> Future:
+        """Queue a turn (store_turn's keyword arguments) for the next group commit"""
+        future = Future()
+        if self._thread is None:
+            future.set_exception(RuntimeError("Turn writer is not running"))
+        else:
+            self._queue.put((turn, future))
+        return future
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._write(batch)
+
+    def _write(self, batch: List[Tuple[Dict, Future]]):
+        errors = {}
+        try:
+            with transaction(immediate=True):
+                for i, (turn, _) in enumerate(batch):
+                    try:
+                        store_turn(**turn)
+                    except Exception as e:
+                        errors[i] = e
+        except Exception as e:
+            logger.error(f"❌ Group commit of {len(batch)} turns failed: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        logger.debug(f"💾 Group commit: {len(batch) - len(errors)} turns")
+        for i, (_, future) in enumerate(batch):
+            if i in errors:
+                future.set_exception(errors[i])
+            else:
+                future.set_result(None)
+
+
+turn_writer = TurnWriter(TURN_GROUP_MAX_DELAY, TURN_GROUP_MAX_SIZE)
+
+
+def save_turn(session_id: str, prompt: str, response: str, **usage):
+    """Store a finished turn, through the group-commit queue when it is running.
+
+    Returns once the turn is committed either way, so the next turn (in
+    any worker process) always sees it.
+    """
+    if turn_writer.running:
+        turn_writer.submit(session_id=session_id, prompt=prompt, response=response, **usage).result()
+    else:
+        store_turn(session_id, prompt, response, **usage)